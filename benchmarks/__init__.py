@@ -0,0 +1,11 @@
+"""
+Benchmarks of the simulator and the app loop.
+
+    python -m benchmarks --out results.json
+    python -m benchmarks --baseline benchmarks/baseline.json
+
+Every case is timed over several repeats and reported as JSON. Against a
+baseline, a case whose median time grew by more than the threshold is
+flagged as a regression and the exit status is 1, as it is when a case with
+a time budget (the startup and rerun cases) goes over it.
+"""
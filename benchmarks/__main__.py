@@ -0,0 +1,164 @@
+"""
+Run the benchmarks, see `benchmarks`.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.cases import CASES
+
+
+def measure(fn, repeat=5, min_time=0.2):
+    """
+    Seconds per call of fn over `repeat` rounds. Each round makes enough
+    calls to last about min_time / repeat seconds.
+    """
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+    number = max(int(min_time / repeat / max(first, 1e-9)), 1)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return number, np.array(times)
+
+
+def run(names, repeat=5, min_time=0.2):
+    results = {}
+    for name in names:
+        setup, ops, unit, budget = CASES[name]
+        number, times = measure(setup(), repeat, min_time)
+        median = float(np.median(times))
+        results[name] = {
+            "budget": budget,
+            "median": median,
+            "min": float(times.min()),
+            "max": float(times.max()),
+            "repeat": repeat,
+            "number": number,
+            "unit": unit,
+            "per_second": ops / median,
+        }
+        flag = "  OVER BUDGET" if budget is not None and median > budget else ""
+        print(
+            f"{name:<24} {median * 1000:10.3f} ms {ops / median:14,.0f} {unit}/s{flag}",
+            file=sys.stderr,
+        )
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+
+def compare(results, baseline, threshold=0.25):
+    """
+    Ratio of the current to the baseline median of every case in both, and
+    the cases that got slower by more than `threshold`
+    """
+    ratios = {
+        name: results[name]["median"] / baseline[name]["median"]
+        for name in results
+        if name in baseline
+    }
+    regressions = [name for name, ratio in ratios.items() if ratio > 1 + threshold]
+    return ratios, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description=__doc__.strip()
+    )
+    parser.add_argument(
+        "--only", action="append", choices=list(CASES), help="case to run, repeat"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--min-time", type=float, default=0.2, help="seconds to spend per case"
+    )
+    parser.add_argument("--out", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="relative slowdown flagged as a regression",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="write the results to the --baseline file instead of comparing",
+    )
+    args = parser.parse_args(argv)
+
+    if args.save_baseline and not args.baseline:
+        parser.error("--save-baseline needs --baseline")
+
+    report = {
+        "environment": environment(),
+        "results": run(args.only or list(CASES), args.repeat, args.min_time),
+    }
+
+    over = [
+        name
+        for name, result in report["results"].items()
+        if result["budget"] is not None and result["median"] > result["budget"]
+    ]
+    report["over_budget"] = over
+    status = 1 if over else 0
+    if args.baseline and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        ratios, regressions = compare(report["results"], baseline, args.threshold)
+        report["baseline"] = {
+            "path": args.baseline,
+            "threshold": args.threshold,
+            "ratios": ratios,
+            "regressions": regressions,
+        }
+        for name, ratio in ratios.items():
+            flag = "  REGRESSION" if name in regressions else ""
+            print(f"{name:<24} {ratio:6.2f}x baseline{flag}", file=sys.stderr)
+        status = 1 if regressions or over else 0
+
+    text = json.dumps(report, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(text + "\n")
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    elif not args.save_baseline:
+        print(text)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+Benchmark cases.
+
+A case is a setup function registered with `@case`. It builds its inputs and
+returns the function to time, which takes no arguments. `ops` is the number
+of units (runs, rows, ...) one call handles, for the throughput column.
+A case with a `budget` (s per call) fails the run when it is slower.
+"""
+
+import ast
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from model.run import GLC_F, GLN_F, init_sim, gen, simulate
+from model.batch import init_batch, run_batch
+from model.control import make_controller
+from model.store import Trajectory
+
+CASES = {}
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def case(name, ops=1, unit="calls", budget=None):
+    def register(setup):
+        CASES[name] = (setup, ops, unit, budget)
+        return setup
+
+    return register
+
+
+def _records():
+    return simulate(controller=make_controller("Continuous Feed", F_Glc=0.05))
+
+
+def _overlays(n):
+    return {
+        f"Run {i + 1}": Trajectory.from_records(
+            simulate(controller=make_controller("Bang Control", Glc_SP=10.0 + i))
+        ).to_frame()
+        for i in range(n)
+    }
+
+
+@case("gen_step")
+def gen_step():
+    res = init_sim()
+    return lambda: next(gen(res, GLC_F, GLN_F, 0.0, 0.0, 0.0))
+
+
+@case("simulate_250h", ops=250, unit="steps")
+def simulate_250h():
+    controller = make_controller("Bang Control")
+    return lambda: simulate(controller=controller)
+
+
+@case("batch_1000", ops=1000, unit="runs")
+def batch_1000():
+    state = init_batch(1000, Glc_0=np.linspace(20, 50, 1000))
+    controller = make_controller("Bang Control")
+    return lambda: run_batch(state, feed=controller, record=False)
+
+
+@case("append_dataframe_250", ops=250, unit="rows")
+def append_dataframe_250():
+    # how the app grew its data frame before the trajectory store
+    rows = pd.DataFrame(_records()).to_dict("records")
+
+    def run():
+        data = pd.DataFrame([rows[0]])
+        for row in rows[1:]:
+            data = pd.concat([data, pd.DataFrame([row])], ignore_index=True)
+        return data
+
+    return run
+
+
+@case("append_trajectory_250", ops=250, unit="rows")
+def append_trajectory_250():
+    rows = pd.DataFrame(_records()).to_dict("records")
+
+    def run():
+        data = Trajectory()
+        for row in rows:
+            data.append(row)
+        return data
+
+    return run
+
+
+def _bare_streamlit():
+    import streamlit as st
+    from streamlit import config
+    from streamlit.logger import set_log_level
+
+    # outside `streamlit run` every element call warns about the missing
+    # script context, which is expected here. Parsing the config resets the
+    # log level, so parse it first.
+    config.get_config_options()
+    set_log_level("error")
+    return st
+
+
+def _charts(overlays):
+    from gui.graph import write_XP_graph, write_nutrients_graph, write_volume_graph
+
+    st = _bare_streamlit()
+    data = Trajectory.from_records(_records()).to_frame()
+
+    def run():
+        # built and serialized as in the app
+        for write in [write_XP_graph, write_nutrients_graph, write_volume_graph]:
+            for chart in write(data, overlays):
+                st.vega_lite_chart(*chart, use_container_width=True)
+
+    return run
+
+
+@case("charts_250", ops=6, unit="charts")
+def charts_250():
+    return _charts(None)
+
+
+@case("charts_250_overlays_3", ops=6, unit="charts")
+def charts_250_overlays_3():
+    return _charts(_overlays(3))
+
+
+@case("mk_metrics")
+def mk_metrics():
+    from gui.metrics import mk_metrics
+
+    st = _bare_streamlit()
+    st.session_state["data"] = Trajectory.from_records(_records())
+    return mk_metrics
+
+
+def _app_imports():
+    """
+    Modules imported at the top of app.py
+    """
+    with open(os.path.join(ROOT, "app.py")) as f:
+        tree = ast.parse(f.read())
+    return [
+        alias.name if isinstance(node, ast.Import) else node.module
+        for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+        for alias in (node.names if isinstance(node, ast.Import) else node.names[:1])
+    ]
+
+
+def _python(code):
+    return lambda: subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, check=True, capture_output=True
+    )
+
+
+@case("startup_imports", unit="starts", budget=1.0)
+def startup_imports():
+    # a fresh interpreter importing what app.py imports
+    return _python("import " + ", ".join(_app_imports()))
+
+
+@case("startup_first_run", unit="starts", budget=2.0)
+def startup_first_run():
+    # a fresh interpreter running app.py once, as for the first session
+    return _python(
+        "from streamlit.testing.v1 import AppTest\n"
+        "at = AppTest.from_file('app.py', default_timeout=60)\n"
+        "at.run()\n"
+        "assert not at.exception, at.exception"
+    )
+
+
+@case("app_rerun", unit="reruns", budget=0.25)
+def app_rerun():
+    from streamlit.testing.v1 import AppTest
+
+    _bare_streamlit()
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=60)
+    at.run()
+    return at.run
@@ -1,9 +1,153 @@
-import altair as alt
+import functools
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from model.ensemble import BANDED
 
 ## DO NOT CACHE THE CHARTS
+# Only their Vega-Lite specs are cached, which hold no data. Validating a spec
+# with altair costs far more than drawing it, so each distinct layout is built
+# once per process and every rerun pairs it with the current data. altair is
+# only imported when a new layout is built.
+
+# st.vega_lite_chart(*chart) draws one
+Chart = namedtuple("Chart", ["data", "spec"])
+
+# Points per series sent to the browser when a chart is drawn
+MAX_POINTS = 400
+
+# Run label of the live trajectory, other runs are overlaid dashed
+CURRENT = "Current"
+
+# Suffixes of the ensemble quantile columns, see `model.ensemble`
+BAND = ["low", "median", "high"]
+
+
+def lttb(x, y, n_out):
+    """
+    Indices of the n_out points kept by largest-triangle-three-buckets
+    downsampling. The first and last points are always kept.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # n_out - 2 buckets between the first and the last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt = slice(hi, edges[i + 2]) if i + 2 < len(edges) else slice(n - 1, n)
+        cx, cy = x[nxt].mean(), y[nxt].mean()
+        # twice the area of the triangle between the last kept point, each
+        # candidate and the average of the next bucket
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(area.argmax())
+        keep[i + 1] = a
+
+    return keep
+
+
+def downsample(data, columns, max_points=MAX_POINTS):
+    """
+    Rows of data that keep the shape of each of the columns against t, at
+    most max_points per column
+    """
+    if len(data) <= max_points:
+        return data
+    t = data["t"].to_numpy(dtype="float64")
+    keep = np.unique(
+        np.concatenate(
+            [lttb(t, data[k].to_numpy(dtype="float64"), max_points) for k in columns]
+        )
+    )
+    return data.iloc[keep]
+
+
+def band_columns(bands, columns, start=0):
+    """
+    Low, median and high quantile of each of the columns that `bands` (a
+    `model.ensemble.Ensemble`) tracks, from row `start` on
+    """
+    if bands is None:
+        return {}
+    return {
+        f"{k}_{q}": v
+        for k in columns
+        if k in BANDED
+        for q, v in zip(BAND, bands.band(k, start))
+    }
+
+
+def tag_runs(data, columns, overlays=None, bands=None):
+    """
+    The current run and each overlaid run (label -> DataFrame), downsampled
+    on their own and stacked with a Run column. With `bands`, the current
+    run also gets the ensemble quantiles of each column.
+    """
+    current = data[["t", *columns]].assign(**band_columns(bands, columns))
+    frames = [downsample(current, columns).assign(Run=CURRENT)]
+    for label, run in (overlays or {}).items():
+        frames.append(downsample(run[["t", *columns]], columns).assign(Run=label))
+    return pd.concat(frames, ignore_index=True)
+
+
+def spec_of(chart):
+    """
+    Spec of a layer chart without its placeholder data. Without any top level
+    data, altair would give every layer an empty dataset of its own.
+    """
+    spec = chart.to_dict()
+    spec.pop("data")
+    spec.pop("datasets", None)
+    return spec
+
+
+def run_domain(data):
+    """
+    Run labels of a tagged frame, the current run first
+    """
+    return (CURRENT, *[r for r in data["Run"].unique() if r != CURRENT])
+
+
+def run_dash(runs):
+    """
+    Solid line for the current run, dashed ones for overlays
+    """
+    import altair as alt
+
+    return alt.StrokeDash(
+        "Run:N",
+        scale=alt.Scale(domain=list(runs)),
+        legend=alt.Legend(title="Run") if len(runs) > 1 else None,
+    )
 
 
-def create_layered_graph(data, color, y_axis, title):
+def band_layers(alt, low, median, high, title, mark_color=None, **encoding):
+    """
+    Shaded area between the low and high quantiles and a dotted median line,
+    in `mark_color` or colored by the `encoding` channels
+    """
+    mark = {} if mark_color is None else {"color": mark_color}
+    return [
+        alt.Chart()
+        .mark_area(opacity=0.2, **mark)
+        .encode(x="t:Q", y=alt.Y(low + ":Q", title=title), y2=alt.Y2(high), **encoding),
+        alt.Chart()
+        .mark_line(strokeDash=[2, 2], opacity=0.8, **mark)
+        .encode(x="t:Q", y=alt.Y(median + ":Q", title=title), **encoding),
+    ]
+
+
+@functools.lru_cache(maxsize=256)
+def layered_template(color, y_axis, title, runs, band=False):
+    import altair as alt
+
     # Create a selection that chooses the nearest point & selects based on x-value
     nearest = alt.selection_point(
         nearest=True,
@@ -12,21 +156,30 @@ def create_layered_graph(data, color, y_axis, title):
         empty=False,
     )
 
+    # every layer reads the dataset of the layer chart, so it is only
+    # serialized and sent once
     line = (
-        alt.Chart(data)
+        alt.Chart()
         .mark_line(color=color)
         .encode(
             x=alt.X("t:Q"),
             y=alt.Y((y_axis + ":Q")),
+            strokeDash=run_dash(runs),
         )
     )
 
+    # ensemble quantiles behind the runs
+    bands = (
+        band_layers(alt, *[f"{y_axis}_{q}" for q in BAND], title, color) if band else []
+    )
+
     # First chart for Glc and Lac
     chart = alt.layer(
+        *bands,
         line,
         # Transparent selectors across the chart. This is what tells us
         # the x-value of the cursor
-        alt.Chart(data)
+        alt.Chart()
         .mark_point()
         .encode(
             x=alt.X("t:Q", title="Time (h)"),
@@ -34,12 +187,19 @@ def create_layered_graph(data, color, y_axis, title):
             tooltip=[
                 alt.Tooltip("t", title="Time (h)", type="quantitative", format=".1f"),
                 alt.Tooltip(y_axis, title=title, type="quantitative", format=".1f"),
+                alt.Tooltip("Run", type="nominal"),
+                *[
+                    alt.Tooltip(
+                        f"{y_axis}_{q}", title=q, type="quantitative", format=".1f"
+                    )
+                    for q in (BAND if band else [])
+                ],
             ],
             opacity=alt.value(0),
         )
         .add_params(nearest),
         # Draw a rule at the location of the selection
-        alt.Chart(data)
+        alt.Chart()
         .mark_rule(color=color)
         .encode(
             x=alt.X("t:Q"),
@@ -48,21 +208,20 @@ def create_layered_graph(data, color, y_axis, title):
         line.mark_point().encode(
             opacity=alt.condition(nearest, alt.value(1), alt.value(0))
         ),
+        data=alt.InlineData(values=[]),
     )
 
-    return chart
+    return spec_of(chart)
 
 
-def create_layered_graph_long(data_long, title, colors=None, domain=None):
-    # Set default colors if none are provided
-    if colors is None:
-        colors = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd"]
+def create_layered_graph(data, color, y_axis, title):
+    band = f"{y_axis}_{BAND[0]}" in data
+    return Chart(data, layered_template(color, y_axis, title, run_domain(data), band))
 
-    # Automatically determine domain from data if not provided
-    if domain is None:
-        domain = (
-            data_long[data_long.columns[1]].unique().tolist()
-        )  # Assumes second column is categorical
+
+@functools.lru_cache(maxsize=256)
+def long_template(title, var_name, colors, domain, runs, band=False):
+    import altair as alt
 
     # Determine y-axis title and units based on the title
     if "Nutrient" in title:
@@ -82,26 +241,27 @@ def create_layered_graph_long(data_long, title, colors=None, domain=None):
 
     # Base line chart for each category
     line = (
-        alt.Chart(data_long)
+        alt.Chart()
         .mark_line()
         .encode(
             x=alt.X("t:Q", title="Time (h)"),
             y=alt.Y("Value:Q", title=y_axis_title),
             color=alt.Color(
-                data_long.columns[1] + ":N",
-                scale=alt.Scale(range=colors, domain=domain),
-                title=data_long.columns[1],
+                var_name + ":N",
+                scale=alt.Scale(range=list(colors), domain=list(domain)),
+                title=var_name,
             ),
+            strokeDash=run_dash(runs),
         )
     )
 
     # Pivot the data to create a format suitable for showing all variables in a single tooltip
     tooltip_data = (
-        alt.Chart(data_long)
+        alt.Chart()
         .transform_pivot(
-            data_long.columns[1],  # Pivot on the categorical variable
+            var_name,  # Pivot on the categorical variable
             value="Value",
-            groupby=["t"],
+            groupby=["t", "Run"],
         )
         .mark_rule()
         .encode(
@@ -109,6 +269,7 @@ def create_layered_graph_long(data_long, title, colors=None, domain=None):
             opacity=alt.condition(nearest, alt.value(0.3), alt.value(0)),
             tooltip=[
                 alt.Tooltip("t:Q", title="Time (h)"),
+                alt.Tooltip("Run:N"),
                 *[alt.Tooltip(f"{var}:Q", title=var, format=".2f") for var in domain],
             ],
         )
@@ -120,28 +281,84 @@ def create_layered_graph_long(data_long, title, colors=None, domain=None):
         opacity=alt.condition(nearest, alt.value(1), alt.value(0))
     )
 
+    # ensemble quantiles behind the runs, in the color of each variable
+    bands = (
+        band_layers(
+            alt,
+            *BAND,
+            y_axis_title,
+            color=alt.Color(
+                var_name + ":N",
+                scale=alt.Scale(range=list(colors), domain=list(domain)),
+                legend=None,
+            ),
+        )
+        if band
+        else []
+    )
+
     # Layer line, tooltip, and points together
-    chart = alt.layer(line, tooltip_data, points).properties(title=title)
+    chart = alt.layer(
+        *bands, line, tooltip_data, points, data=alt.InlineData(values=[])
+    ).properties(title=title)
+
+    return spec_of(chart)
 
-    return chart
 
+def create_layered_graph_long(data_long, title, colors=None, domain=None):
+    # Set default colors if none are provided
+    if colors is None:
+        colors = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd"]
+
+    # second column is the categorical one
+    var_name = data_long.columns[1]
+
+    # Automatically determine domain from data if not provided
+    if domain is None:
+        domain = data_long[var_name].unique().tolist()
+
+    spec = long_template(
+        title,
+        var_name,
+        tuple(colors),
+        tuple(domain),
+        run_domain(data_long),
+        BAND[0] in data_long,
+    )
+    return Chart(data_long, spec)
 
-def write_XP_graph(data):
-    data = data[["t", "X", "P"]]
 
-    chart1 = create_layered_graph(data, "black", "X", "Cells (Cells/mL)")
+def melt_runs(data, columns, var_name):
+    long = data.melt(
+        id_vars=["t", "Run"],
+        value_vars=columns,
+        var_name=var_name,
+        value_name="Value",
+    )[["t", var_name, "Value", "Run"]]
+    # melt stacks the columns one after the other, so do the same with the
+    # quantiles of each of them
+    if f"{columns[0]}_{BAND[0]}" in data:
+        for q in BAND:
+            long[q] = np.concatenate([data[f"{k}_{q}"] for k in columns])
+    return long
+
+
+def write_XP_graph(data, overlays=None, bands=None):
+    chart1 = create_layered_graph(
+        tag_runs(data, ["X"], overlays, bands), "black", "X", "Cells (Cells/mL)"
+    )
 
     # Second chart for Gln and Amm
-    chart2 = create_layered_graph(data, "blue", "P", "Product (mg/mL)")
+    chart2 = create_layered_graph(
+        tag_runs(data, ["P"], overlays, bands), "blue", "P", "Product (mg/mL)"
+    )
 
     return chart1, chart2
 
 
-def write_nutrients_graph(data):
-    data = data[["t", "Lac", "Glc", "Gln", "Amm"]]
-
-    data_long = data[["t", "Glc", "Lac"]].melt(
-        id_vars="t", value_vars=["Glc", "Lac"], var_name="Nutrient", value_name="Value"
+def write_nutrients_graph(data, overlays=None, bands=None):
+    data_long = melt_runs(
+        tag_runs(data, ["Glc", "Lac"], overlays, bands), ["Glc", "Lac"], "Nutrient"
     )
 
     chart1 = create_layered_graph_long(
@@ -150,8 +367,8 @@ def write_nutrients_graph(data):
 
     # Second chart for Gln and Amm
 
-    data_long = data[["t", "Gln", "Amm"]].melt(
-        id_vars="t", value_vars=["Gln", "Amm"], var_name="Nutrient", value_name="Value"
+    data_long = melt_runs(
+        tag_runs(data, ["Gln", "Amm"], overlays, bands), ["Gln", "Amm"], "Nutrient"
     )
 
     chart2 = create_layered_graph_long(
@@ -162,14 +379,9 @@ def write_nutrients_graph(data):
     return chart1, chart2
 
 
-def write_volume_graph(data):
-    data = data[["t", "V", "F_Gln", "F_Glc"]]
-
-    data_long = data[["t", "F_Gln", "F_Glc"]].melt(
-        id_vars="t",
-        value_vars=["F_Glc", "F_Gln"],
-        var_name="Feed Flow",
-        value_name="Value",
+def write_volume_graph(data, overlays=None):
+    data_long = melt_runs(
+        tag_runs(data, ["F_Gln", "F_Glc"], overlays), ["F_Glc", "F_Gln"], "Feed Flow"
     )
 
     chart2 = create_layered_graph_long(
@@ -177,7 +389,75 @@ def write_volume_graph(data):
     )
 
     # Second Chart for volume
-    chart1 = create_layered_graph(data, "purple", "V", "Volume (mL)")
+    chart1 = create_layered_graph(
+        tag_runs(data, ["V"], overlays), "purple", "V", "Volume (mL)"
+    )
 
     # Display the charts in Streamlit
     return chart1, chart2
+
+
+class ChartFeed:
+    """
+    Streams rows appended to a trajectory store to the charts drawn above.
+
+    Each chart is registered once with the columns it plots and, for long
+    format charts, the name of the variable column. A flush sends every row
+    added since the last one as a single `add_rows` per chart, and charts
+    showing the same columns share one delta frame. With `bands`, an
+    ensemble kept up to date with the store, the quantiles go along.
+    """
+
+    def __init__(self, data, bands=None):
+        self.data = data
+        self.bands = bands
+        self.sent = len(data)
+        self.charts = []
+
+    def add(self, chart, columns, var_name=None):
+        self.charts.append((chart, tuple(columns), var_name))
+
+    def delta(self, columns, var_name, start):
+        t = self.data["t"][start:]
+        bands = band_columns(self.bands, columns, start)
+        if var_name is None:
+            return pd.DataFrame(
+                {
+                    "t": t,
+                    **{k: self.data[k][start:] for k in columns},
+                    **bands,
+                    "Run": CURRENT,
+                },
+                copy=False,
+            )
+        # same layout as DataFrame.melt: all rows of the first column, then
+        # all rows of the next one
+        frame = pd.DataFrame(
+            {
+                "t": np.tile(t, len(columns)),
+                var_name: np.repeat(columns, len(t)),
+                "Value": np.concatenate([self.data[k][start:] for k in columns]),
+                "Run": CURRENT,
+            }
+        )
+        if len(bands) == len(columns) * len(BAND):
+            for q in BAND:
+                frame[q] = np.concatenate([bands[f"{k}_{q}"] for k in columns])
+        return frame
+
+    def flush(self):
+        """
+        Send the new rows, returns how many there were
+        """
+        start, n = self.sent, len(self.data) - self.sent
+        if n <= 0:
+            return 0
+
+        deltas = {}
+        for chart, columns, var_name in self.charts:
+            if (columns, var_name) not in deltas:
+                deltas[columns, var_name] = self.delta(columns, var_name, start)
+            chart.add_rows(deltas[columns, var_name])
+
+        self.sent = len(self.data)
+        return n
@@ -1,8 +1,38 @@
 import streamlit as st
 from pandas import DataFrame
 
+UNITS = [
+    "1/h",
+    "mM",
+    "mM",
+    "c/mmol",
+    "mmol/c*h",
+    "mM*mL/c*h",
+    "mM",
+    "M/M",
+    "M/M",
+    "ug/c",
+    "ug/c*h",
+    "mM",
+    "mM",
+    "mM",
+    "mM",
+    "mM",
+]
+
+
+@st.cache_resource
+def constants_table(params):
+    """
+    Kinetic constants with their units, built once and shared by every
+    session. Callers must not modify it.
+    """
+    df = DataFrame.from_dict(params, orient="index")
+    df = df.rename(columns={0: "Values"})
+    df["Units"] = UNITS
+    return df
+
 
-# @st.cache_resource
 def render_instructions(params):
     col1, col2 = st.columns(2)
     col1.markdown(
@@ -50,29 +80,9 @@ def render_instructions(params):
     st.markdown(
         "The following table shows the kinetic constants for the simulation. Try editing the value column to see the effect that has on the simulation. You will not be able to edit the parameters after the simulation starts!"
     )
-    df = DataFrame.from_dict(params, orient="index")
-
-    st.session_state.param_df = df
+    df = constants_table(params)
 
-    df = df.rename(columns={0: "Values"})
-    df["Units"] = [
-        "1/h",
-        "mM",
-        "mM",
-        "c/mmol",
-        "mmol/c*h",
-        "mM*mL/c*h",
-        "mM",
-        "M/M",
-        "M/M",
-        "ug/c",
-        "ug/c*h",
-        "mM",
-        "mM",
-        "mM",
-        "mM",
-        "mM",
-    ]
+    st.session_state.param_df = df["Values"]
 
     param_df = st.data_editor(
         df,
@@ -11,7 +11,7 @@ def mk_metrics():
         )
     else:
         st.markdown(
-            f"##### Bioreactor Process Monitoring Dashboard. $t={st.session_state['data']['t'].iloc[-1]}$ hrs"
+            f"##### Bioreactor Process Monitoring Dashboard. $t={st.session_state['data']['t'][-1]}$ hrs"
         )
 
     col1, col2, col3 = st.columns(3)
@@ -31,12 +31,9 @@ def mk_metrics():
         col3.markdown("Flowrate of glutamine into the reactor")
     else:
         data = st.session_state["data"]
-        values = data.iloc[-1]
-
-        if data.shape[0] > 1:
-            delta = data.iloc[-1] - data.iloc[-2]
-        else:
-            delta = data.iloc[-1] - data.iloc[-1]
+        values = data.last()
+        previous = data.row(-2) if len(data) > 1 else values
+        delta = {k: values[k] - previous[k] for k in values}
 
         col1.metric(
             "$X_v$",
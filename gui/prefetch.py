@@ -0,0 +1,87 @@
+"""
+Compute-ahead playback.
+
+The rest of the run is simulated in a background thread and every rerun only
+appends frames that are already computed, so the speed slider sets the
+playback rate instead of the compute rate. Changing the controls or the step
+time drops the pending frames and simulates again from the current time, the
+step time being logged in the control schedule with the controls.
+
+Trajectories go through the shared result cache, so a scenario that was run
+before plays back at once and a control change resumes from the cached state.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from model.cache import default_cache
+from model.scenario import scenario_key, simulate_scenario
+
+# frames per second at 1x
+FRAME_RATE = 10
+
+# shared by every session of this server process
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+
+
+class Prefetcher:
+    """
+    Frames of one session, computed ahead for a fixed set of controls
+    """
+
+    def __init__(self):
+        self.key = None
+        self.future = None
+        self.frames = None
+        self.pos = 0
+        self.t = None
+        self.clock = None
+
+    def invalidate(self):
+        if self.future is not None:
+            self.future.cancel()
+        self.key = self.future = self.frames = None
+        self.pos = 0
+        self.clock = None
+
+    def request(self, scenario, t):
+        """
+        Make sure the frames of `scenario` after time t are computed
+        """
+        key = scenario_key(scenario)
+        if key == self.key and t == self.t:
+            return
+        self.invalidate()
+        self.key = key
+        self.t = t
+        self.future = _executor.submit(simulate_scenario, scenario, default_cache())
+
+    def take(self, rate):
+        """
+        Frames due since the last call when playing `rate` frames per second.
+        Returns None while they are still being computed or before the next
+        frame is due, and an empty array once the run is over.
+        """
+        if self.frames is None:
+            if not self.future.done():
+                return None
+            records = self.future.result()
+            self.frames = records[records["t"] > self.t + 1e-9 * max(abs(self.t), 1)]
+
+        now = time.perf_counter()
+        if self.clock is None:
+            # the first frame is due at once
+            self.clock = now - 1 / rate
+        # never skip more than a second of playback, e.g. after a slow rerun
+        self.clock = max(self.clock, now - max(int(rate), 1) / rate)
+        due = int((now - self.clock) * rate + 1e-9)
+        if not due:
+            return None
+        # the part of a frame not yet due carries over to the next call
+        self.clock += due / rate
+
+        chunk = self.frames[self.pos : self.pos + due]
+        self.pos += len(chunk)
+        if len(chunk):
+            self.t = float(chunk["t"][-1])
+        return chunk
@@ -0,0 +1,102 @@
+import streamlit as st
+
+from gui.sidebar import control_settings
+from gui.session import run_registry
+from model.ensemble import Ensemble, schedule_concentrations
+from model.scenario import reproducible, scenario, scenario_key
+
+
+def current_scenario(t_max):
+    """
+    Scenario of the run in progress, with the controls used so far
+    """
+    return scenario(
+        st.session_state.initial,
+        st.session_state.params,
+        st.session_state.schedule,
+        dt=st.session_state.app_dt,
+        t_max=t_max,
+    )
+
+
+def current_ensemble():
+    """
+    Ensemble following the run in progress, brought up to date with it, or
+    None with the uncertainty bands off. It is drawn again when its settings
+    or the run change.
+    """
+    data = st.session_state.get("data")
+    if not st.session_state.get("uncertainty") or data is None:
+        st.session_state.pop("ensemble", None)
+        return None
+
+    key = (
+        st.session_state.members,
+        st.session_state.spread,
+        scenario_key(scenario(st.session_state.initial, st.session_state.params)),
+    )
+    cached = st.session_state.get("ensemble")
+    if cached is None or cached[0] != key or len(cached[1]) > len(data):
+        ensemble = Ensemble(
+            st.session_state.initial,
+            st.session_state.params,
+            n=st.session_state.members,
+            cv=st.session_state.spread / 100,
+        )
+        st.session_state.ensemble = cached = (key, ensemble)
+
+    concentrations = schedule_concentrations(
+        st.session_state.schedule, st.session_state.params
+    )
+    return cached[1].sync(data, concentrations)
+
+
+def record_controls(t):
+    """
+    Log the control settings and step time in use from time t on, if they
+    changed
+    """
+    mode, settings = control_settings()
+    controls = (mode, settings, float(st.session_state.app_dt))
+    schedule = st.session_state.setdefault("schedule", [])
+    if not schedule or schedule[-1][1:] != controls:
+        schedule.append((float(t), *controls))
+
+
+def register_run(t_max):
+    """
+    Keep the finished run for comparison
+    """
+    runs = run_registry()
+    modes = list(dict.fromkeys(entry[1] for entry in st.session_state.schedule))
+    label = "Run {}: {}".format(
+        st.session_state.get("run_count", 0) + 1, " → ".join(modes)
+    )
+    current = current_scenario(t_max)
+    key = scenario_key(current)
+    if not reproducible(current):
+        # stepped against a time budget, another run of it may differ
+        key = "{}-{}".format(key, st.session_state.get("run_count", 0) + 1)
+    if key not in runs:
+        st.session_state.run_count = st.session_state.get("run_count", 0) + 1
+        runs.add(key, st.session_state["data"], label)
+
+
+def mk_run_picker():
+    """
+    Select finished runs to overlay on the charts. Returns label -> DataFrame.
+    """
+    runs = st.session_state.get("runs")
+    if not runs:
+        return {}
+
+    selected = st.multiselect(
+        "Compare Runs",
+        runs.keys(),
+        format_func=runs.label,
+        help="Overlay finished runs on the charts, dashed",
+    )
+    return {
+        runs.label(key): traj.to_frame()
+        for key, traj in zip(selected, runs.get_many(selected))
+    }
@@ -0,0 +1,118 @@
+"""
+Session memory: accounting, caps and idle spill.
+
+Each session keeps its trajectory, the finished runs it can overlay, the last
+export, the frames computed ahead and the uncertainty ensemble. `footprint`
+reports what those take, finished runs are capped per session, and the runs
+of a session idle for IDLE_AFTER seconds are moved to disk until it is used
+again.
+
+The limits are read from the environment:
+
+    BIOREACTOR_HISTORY_DTYPE   dtype of the live trajectory (float64)
+    BIOREACTOR_RUN_BUDGET_MB   memory for finished runs per session (8)
+    BIOREACTOR_MAX_RUNS        finished runs kept per session (10)
+    BIOREACTOR_IDLE_AFTER      seconds before an idle session is spilled (600)
+    BIOREACTOR_SPILL_DIR       where spilled runs go (a temporary directory)
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from model.store import RunRegistry
+
+HISTORY_DTYPE = os.environ.get("BIOREACTOR_HISTORY_DTYPE", "float64")
+RUN_BUDGET = float(os.environ.get("BIOREACTOR_RUN_BUDGET_MB", 8)) * 2**20
+MAX_RUNS = int(os.environ.get("BIOREACTOR_MAX_RUNS", 10))
+IDLE_AFTER = float(os.environ.get("BIOREACTOR_IDLE_AFTER", 600))
+SPILL_DIR = os.environ.get(
+    "BIOREACTOR_SPILL_DIR",
+    os.path.join(tempfile.gettempdir(), "bioreactor-sessions"),
+)
+
+# session id -> (last rerun, weak reference to its RunRegistry or None)
+_sessions = {}
+_lock = threading.Lock()
+
+
+def run_registry():
+    """
+    The finished runs of this session
+    """
+    if "runs" not in st.session_state:
+        st.session_state.runs = RunRegistry(budget=RUN_BUDGET, max_runs=MAX_RUNS)
+        # track it from now on, the session may go idle without another rerun
+        touch()
+    return st.session_state.runs
+
+
+def _spill_dir(session_id):
+    return os.path.join(SPILL_DIR, session_id)
+
+
+def touch():
+    """
+    Mark this session as active and spill the runs of the idle ones. Called
+    at the start of every rerun.
+    """
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+
+    now = time.monotonic()
+    runs = st.session_state.get("runs")
+    idle = []
+    with _lock:
+        _sessions[ctx.session_id] = (now, None if runs is None else weakref.ref(runs))
+        for session_id, (seen, ref) in list(_sessions.items()):
+            registry = None if ref is None else ref()
+            if registry is None and (ref is not None or now - seen > IDLE_AFTER):
+                # closed, or idle with nothing to spill
+                del _sessions[session_id]
+                shutil.rmtree(_spill_dir(session_id), ignore_errors=True)
+            elif registry is not None and now - seen > IDLE_AFTER:
+                idle.append((session_id, registry))
+
+    for session_id, registry in idle:
+        registry.spill(_spill_dir(session_id))
+
+
+def footprint():
+    """
+    Bytes held by this session, by session state key
+    """
+    state = st.session_state
+    sizes = {}
+    if "data" in state:
+        sizes["data"] = state.data.nbytes
+    if "runs" in state:
+        sizes["runs"] = state.runs.nbytes
+    if "export" in state:
+        sizes["export"] = len(state.export[3])
+    if "ensemble" in state:
+        sizes["ensemble"] = state.ensemble[1].nbytes
+    prefetch = state.get("prefetch")
+    if prefetch is not None and prefetch.frames is not None:
+        sizes["prefetch"] = prefetch.frames.nbytes
+    if "timer" in state:
+        # a float object and a deque slot per sample
+        sizes["timer"] = 32 * sum(len(v) for v in state.timer.samples.values())
+    return sizes
+
+
+def process_footprint():
+    """
+    Sessions seen by this process and the bytes of finished runs they hold
+    in memory
+    """
+    with _lock:
+        refs = [ref for _, ref in _sessions.values()]
+    registries = [ref() for ref in refs if ref is not None]
+    return len(refs), sum(r.nbytes for r in registries if r is not None)
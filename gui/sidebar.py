@@ -1,9 +1,13 @@
 import streamlit as st
 import numpy as np
-from pandas import DataFrame
 
-BOLUS_TIMES = [1.0, 25.0, 50.0, 100.0]
-DEADBAND = 0.5
+from model.optimize import optimize, SPACE
+from model.export import to_bytes, FORMATS
+from model.control import make_controller, MPC, BOLUS_TIMES, DEADBAND
+
+OBJECTIVES = {"Final Product": "P_final", "Peak Cells": "X_max"}
+
+EXPORTS = {"CSV": "csv", "Parquet": "parquet", "Arrow": "arrow", "NPZ": "npz"}
 
 if "data" not in st.session_state:
     simulation_inited = False
@@ -11,11 +15,20 @@ else:
     simulation_inited = True
 
 
-def download_data():
-    if "data" in st.session_state:
-        return st.session_state["data"].to_csv().encode("utf-8")
-    else:
-        return DataFrame().to_csv().encode("utf-8")
+def download_data(fmt="csv"):
+    """
+    Export of the current run. It is only built while the download button is
+    enabled, and reused until the trajectory changes.
+    """
+    data = st.session_state.get("data")
+    if data is None or st.session_state.auto_refresh:
+        return b""
+
+    cached = st.session_state.get("export")
+    if cached is None or cached[0] is not data or cached[1:3] != (data.version, fmt):
+        payload = to_bytes(data.to_frame(), fmt)
+        st.session_state.export = (data, data.version, fmt, payload)
+    return st.session_state.export[3]
 
 
 def alert_user(Glc, Gln):
@@ -42,12 +55,112 @@ def toggle_simulation():
 
 def reset_sim():
     st.toast("Simulation Reset!")
+    st.session_state.pop("prefetch", None)
+    st.session_state.pop("export", None)
+    st.session_state.pop("controller", None)
+    st.session_state.pop("ensemble", None)
     try:
         del st.session_state["data"]
     except KeyError:
         return
 
 
+def control_settings():
+    """
+    Settings of the selected control scheme, as `make_controller` expects them
+    """
+    mode = st.session_state.control_mode
+    F_Glc, F_Gln = st.session_state.flows
+    if mode == "Bolus Feed":
+        settings = {f"bolus_{i}": v for i, v in enumerate(st.session_state.bolus_feeds)}
+    elif mode == "MPC":
+        Glc_SP, Gln_SP = st.session_state.SP
+        horizon, budget = st.session_state.mpc
+        settings = dict(
+            F_Glc=F_Glc,
+            F_Gln=F_Gln,
+            Glc_SP=Glc_SP,
+            Gln_SP=Gln_SP,
+            horizon=horizon,
+            budget=budget / 1000,
+        )
+    elif mode == "Bang Control":
+        Glc_SP, Gln_SP = st.session_state.SP
+        Glc_DB, Gln_DB = st.session_state.DB
+        settings = dict(
+            F_Glc=F_Glc,
+            F_Gln=F_Gln,
+            Glc_SP=Glc_SP,
+            Gln_SP=Gln_SP,
+            Glc_DB=Glc_DB,
+            Gln_DB=Gln_DB,
+        )
+    else:
+        t0_glc, tn_glc = st.session_state.t_glc
+        t0_gln, tn_gln = st.session_state.t_gln
+        settings = dict(
+            F_Glc=F_Glc,
+            F_Gln=F_Gln,
+            t0_glc=t0_glc,
+            tn_glc=tn_glc,
+            t0_gln=t0_gln,
+            tn_gln=tn_gln,
+        )
+    return mode, {k: float(v) for k, v in settings.items()}
+
+
+def current_controller():
+    """
+    Controller for the selected scheme and settings. It is kept in the
+    session so that controllers with memory (PID, MPC) carry it over reruns,
+    and starts over with a new step time, as a new schedule entry does in
+    `model.scenario.simulate_scenario`.
+    """
+    mode, settings = control_settings()
+    key = (mode, tuple(sorted(settings.items())), st.session_state.app_dt)
+    cached = st.session_state.get("controller")
+    if cached is None or cached[0] != key:
+        st.session_state.controller = (
+            key,
+            make_controller(mode, params=st.session_state.get("params"), **settings),
+        )
+    return st.session_state.controller[1]
+
+
+def optimize_settings(control_scheme, objective, V_max):
+    """
+    Search the settings of the current control scheme and use the best ones
+    as the new widget values
+    """
+    [Glc_0, Gln_0, X_0, P_0, Amm, Lac, V] = st.session_state.initial_vals
+    params = (
+        st.session_state.param_df.to_dict() if "param_df" in st.session_state else None
+    )
+
+    result = optimize(
+        control_scheme,
+        objective=OBJECTIVES[objective],
+        initial=dict(
+            X_0=X_0, Glc_0=Glc_0, Gln_0=Gln_0, Lac_0=Lac, Amm_0=Amm, P_0=P_0, V_0=V
+        ),
+        params=params,
+        V_max=V_max,
+        alarms=tuple(st.session_state.alarms),
+        dt=st.session_state.app_dt,
+        cache=st.session_state.setdefault("optimizer_cache", {}),
+    )
+
+    st.session_state.setdefault("tuned", {})[control_scheme] = result["settings"]
+    if result["feasible"]:
+        st.toast(
+            "Optimized settings applied, {} = {:.4g}".format(objective, result["score"])
+        )
+    else:
+        st.toast(
+            "No settings found that respect the alarms and volume limit", icon="🚨"
+        )
+
+
 def mk_sidebar(title="Default Title", caption="Default Caption"):
     """
     Title & Caption
@@ -69,10 +182,32 @@ def mk_sidebar(title="Default Title", caption="Default Caption"):
             on_change=toggle_simulation,
         )
 
-        if "data" in st.session_state:
-            st.markdown(
-                f"Simulation Time: *{st.session_state['data']['t'].iloc[-1]}* h"
+        st.toggle(
+            "Compute Ahead",
+            key="compute_ahead",
+            help="Simulate the rest of the run in the background and play it "
+            "back. Changing the controls recomputes from the current time.",
+        )
+
+        st.toggle(
+            "Uncertainty Bands",
+            key="uncertainty",
+            help="Run an ensemble with the kinetic constants drawn around their "
+            "values, fed like the current run, and shade the 5-95% band of "
+            "the cells, product and nutrients with a dotted median.",
+        )
+        if st.session_state.uncertainty:
+            col1, col2 = st.columns(2)
+            col1.select_slider(
+                "Ensemble Members",
+                options=[50, 100, 200, 500],
+                value=200,
+                key="members",
             )
+            col2.slider("Parameter Spread (%)", 1, 50, value=10, key="spread")
+
+        if "data" in st.session_state:
+            st.markdown(f"Simulation Time: *{st.session_state['data']['t'][-1]}* h")
 
         app_dt = st.select_slider(
             "Select Simulation Step Time",
@@ -88,15 +223,18 @@ def mk_sidebar(title="Default Title", caption="Default Caption"):
         st.session_state.app_dt = int(app_dt[0])
 
         speed = st.select_slider("Simulation Speed:", options=["1x", "2x", "3x"])
-        st.session_state.sleep_time = 0.1 / int(speed[0])
+        st.session_state.speed = int(speed[0])
+        st.session_state.sleep_time = 0.1 / st.session_state.speed
+
+        export = st.selectbox("Export Format", list(EXPORTS))
+        fmt = EXPORTS[export]
 
         col1, col2 = st.columns(2)
-        csv = download_data()
         col1.download_button(
-            ":arrow_down: Download CSV",
-            data=csv,
-            mime="text/csv",
-            file_name="simulation_data.csv",
+            f":arrow_down: Download {export}",
+            data=download_data(fmt),
+            mime=FORMATS[fmt],
+            file_name=f"simulation_data.{fmt}",
             disabled=st.session_state.auto_refresh,
             help="Get data from simulation. Stop the simulation to enable.",
         )
@@ -169,33 +307,54 @@ def mk_sidebar(title="Default Title", caption="Default Caption"):
 
         control_scheme = st.radio(
             "Select a Control Scheme",
-            ["Bolus Feed", "Continuous Feed", "Bang Control"],
+            ["Bolus Feed", "Continuous Feed", "Bang Control", "MPC"],
             index=1,
         )
 
+        # settings suggested by the optimizer become the widget defaults
+        tuned = st.session_state.get("tuned", {}).get(control_scheme, {})
+
         st.subheader("**Feed Flowrates**")
         if control_scheme == "Bang Control":
 
             col3, col4 = st.columns(2)
             with col3:
                 Glc_SP = st.number_input(
-                    "Glc Setpoint (mM)", value=20.0, min_value=0.0, max_value=60.0
+                    "Glc Setpoint (mM)",
+                    value=tuned.get("Glc_SP", 20.0),
+                    min_value=0.0,
+                    max_value=60.0,
                 )
                 Glc_DB = st.number_input(
-                    "Glc Deadband", value=DEADBAND, min_value=0.0, max_value=15.0
+                    "Glc Deadband",
+                    value=tuned.get("Glc_DB", DEADBAND),
+                    min_value=0.0,
+                    max_value=15.0,
                 )
                 F_Glc = st.number_input(
-                    "$F_{Glc}$ (L/h)", value=1.0, min_value=0.0, max_value=2.0
+                    "$F_{Glc}$ (L/h)",
+                    value=tuned.get("F_Glc", 1.0),
+                    min_value=0.0,
+                    max_value=2.0,
                 )
             with col4:
                 Gln_SP = st.number_input(
-                    "Gln Setpoint (mM)", value=0.0, min_value=0.0, max_value=15.0
+                    "Gln Setpoint (mM)",
+                    value=tuned.get("Gln_SP", 0.0),
+                    min_value=0.0,
+                    max_value=15.0,
                 )
                 Gln_DB = st.number_input(
-                    "Gln Deadband", value=DEADBAND, min_value=0.0, max_value=15.0
+                    "Gln Deadband",
+                    value=tuned.get("Gln_DB", DEADBAND),
+                    min_value=0.0,
+                    max_value=15.0,
                 )
                 F_Gln = st.number_input(
-                    "$F_{Gln}$ (L/h)", value=1.0, min_value=0.0, max_value=2.0
+                    "$F_{Gln}$ (L/h)",
+                    value=tuned.get("F_Gln", 1.0),
+                    min_value=0.0,
+                    max_value=2.0,
                 )
 
             st.session_state.SP = [Glc_SP, Gln_SP]
@@ -203,6 +362,51 @@ def mk_sidebar(title="Default Title", caption="Default Caption"):
             t0_glc, tn_glc = (0.0, 0.0)
             t0_gln, tn_gln = (0.0, 0.0)
 
+        elif control_scheme == "MPC":
+
+            col3, col4 = st.columns(2)
+            with col3:
+                Glc_SP = st.number_input(
+                    "Glc Setpoint (mM)", value=20.0, min_value=0.0, max_value=60.0
+                )
+                F_Glc = st.number_input(
+                    "Max $F_{Glc}$ (L/h)", value=1.0, min_value=0.0, max_value=2.0
+                )
+            with col4:
+                Gln_SP = st.number_input(
+                    "Gln Setpoint (mM)", value=2.0, min_value=0.0, max_value=15.0
+                )
+                F_Gln = st.number_input(
+                    "Max $F_{Gln}$ (L/h)", value=1.0, min_value=0.0, max_value=2.0
+                )
+
+            horizon = st.select_slider(
+                "Prediction Horizon (h)", options=[8, 12, 24, 36, 48], value=24
+            )
+            budget = st.number_input(
+                "Solve Budget (ms)",
+                value=50.0,
+                min_value=1.0,
+                max_value=1000.0,
+                help="Time allowed for each control decision",
+            )
+
+            # solve times of the controller driving the run
+            controller = st.session_state.get("controller", (None, None))[1]
+            if isinstance(controller, MPC) and controller.timings:
+                latency = controller.latency()
+                st.caption(
+                    "Solve time {last:.1f} ms, p95 {p95:.1f} ms over {decisions} "
+                    "decisions, {within:.0%} within budget".format(
+                        within=latency["within_budget"], **latency
+                    )
+                )
+
+            st.session_state.SP = [Glc_SP, Gln_SP]
+            st.session_state.mpc = [horizon, budget]
+            t0_glc, tn_glc = (0.0, 0.0)
+            t0_gln, tn_gln = (0.0, 0.0)
+
         elif control_scheme == "Bolus Feed":
 
             options = ["{:0} h".format(int(time)) for time in BOLUS_TIMES[:4]]
@@ -211,6 +415,7 @@ def mk_sidebar(title="Default Title", caption="Default Caption"):
                 "Select Feed Time",
                 options,
                 selection_mode="multi",
+                default=[o for i, o in enumerate(options) if tuned.get(f"bolus_{i}")],
             )
 
             def isSelected(i):
@@ -223,14 +428,14 @@ def mk_sidebar(title="Default Title", caption="Default Caption"):
             with col3:
                 V_Glc_0 = st.number_input(
                     f"$V_F,{options[0]}$ (mL)",
-                    value=0.0,
+                    value=tuned.get("bolus_0", 0.0),
                     min_value=0.0,
                     max_value=1500.0,
                     disabled=isSelected(0),
                 )
                 V_Glc_1 = st.number_input(
                     f"$V_t,{options[1]}$ (mL)",
-                    value=0.0,
+                    value=tuned.get("bolus_1", 0.0),
                     min_value=0.0,
                     max_value=1500.0,
                     disabled=isSelected(1),
@@ -238,14 +443,14 @@ def mk_sidebar(title="Default Title", caption="Default Caption"):
             with col4:
                 V_Glc_2 = st.number_input(
                     f"$V_t,{options[2]}$ (mL)",
-                    value=0.0,
+                    value=tuned.get("bolus_2", 0.0),
                     min_value=0.0,
                     max_value=1500.0,
                     disabled=isSelected(2),
                 )
                 V_Glc_3 = st.number_input(
                     f"$V_t,{options[3]}$ (mL)",
-                    value=0.0,
+                    value=tuned.get("bolus_3", 0.0),
                     min_value=0.0,
                     max_value=1500.0,
                     disabled=isSelected(3),
@@ -259,24 +464,36 @@ def mk_sidebar(title="Default Title", caption="Default Caption"):
             col3, col4 = st.columns(2)
             with col3:
                 F_Glc = st.number_input(
-                    "$F_{Glc}$ (L/h)", value=0.0, min_value=0.0, max_value=5.0
+                    "$F_{Glc}$ (L/h)",
+                    value=tuned.get("F_Glc", 0.0),
+                    min_value=0.0,
+                    max_value=5.0,
                 )
             with col4:
                 F_Gln = st.number_input(
-                    "$F_{Gln}$ (L/h)", value=0.0, min_value=0.0, max_value=5.0
+                    "$F_{Gln}$ (L/h)",
+                    value=tuned.get("F_Gln", 0.0),
+                    min_value=0.0,
+                    max_value=5.0,
                 )
 
             st.subheader("**Dosing Times**")
             t0_glc, tn_glc = st.select_slider(
                 "Glucose Dosing Time (h)",
                 options=np.arange(0, 251, 25),
-                value=(175, 225),
+                value=(
+                    int(tuned.get("t0_glc", 175)),
+                    int(tuned.get("tn_glc", 225)),
+                ),
             )
 
             t0_gln, tn_gln = st.select_slider(
                 "Glutamine Dosing Time (h)",
                 options=np.arange(0, 251, 25),
-                value=(175, 225),
+                value=(
+                    int(tuned.get("t0_gln", 175)),
+                    int(tuned.get("tn_gln", 225)),
+                ),
             )
 
         st.subheader("**Alarms**")
@@ -289,6 +506,21 @@ def mk_sidebar(title="Default Title", caption="Default Caption"):
             "Max Gln (mM)", value=10.0, min_value=0.0, max_value=100.0
         )
 
+        st.subheader("**Optimizer**")
+        objective = st.selectbox("Maximize", list(OBJECTIVES))
+        V_max = st.number_input(
+            "Max Volume (mL)", value=2000.0, min_value=0.0, max_value=10000.0
+        )
+        st.button(
+            "Optimize Settings",
+            on_click=optimize_settings,
+            args=(control_scheme, objective, V_max),
+            disabled=st.session_state.auto_refresh or control_scheme not in SPACE,
+            help="Search the settings of the selected control scheme. "
+            "Uses the initial conditions, kinetic constants and alarms above.",
+            use_container_width=True,
+        )
+
         st.session_state.control_mode = control_scheme
         st.session_state.initial_vals = [Glc_0, Gln_0, X_0, P_0, Amm, Lac, V]
         st.session_state.flows = [F_Glc, F_Gln]
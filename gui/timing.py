@@ -0,0 +1,180 @@
+"""
+Per-rerun phase timing.
+
+With diagnostics on, every rerun of a session times its phases (building the
+sidebar, the metrics, the data frame and the charts, the simulation step,
+the uncertainty ensemble, add_rows and the sleep before the next rerun) and
+keeps the last WINDOW reruns, so the percentiles shown in the diagnostics
+panel follow the tail latency of the live loop. Diagnostics are switched on
+from the sidebar, or for every session by setting BIOREACTOR_DIAGNOSTICS=1.
+
+    start_rerun()
+    with phase("metrics"):
+        mk_metrics()
+"""
+
+import json
+import os
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from gui.session import footprint, process_footprint
+
+PHASES = [
+    "sidebar",
+    "metrics",
+    "assembly",
+    "charts",
+    "step",
+    "ensemble",
+    "add_rows",
+    "sleep",
+]
+
+# reruns kept per session
+WINDOW = 500
+
+PERCENTILES = [50, 90, 99]
+
+ENABLED = os.environ.get("BIOREACTOR_DIAGNOSTICS", "") not in ("", "0")
+
+
+class RerunTimer:
+    """
+    Rolling window of phase durations (s), one sample per rerun. A rerun is
+    only added once the next one starts, when all of its phases are done.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.samples = {k: deque(maxlen=window) for k in PHASES + ["total"]}
+        self.reruns = 0
+        self._current = None
+        self._start = self._end = None
+        self._json = (None, None)
+
+    def start(self):
+        self.commit()
+        self._current = {}
+        self._start = self._end = time.perf_counter()
+
+    def commit(self):
+        if self._current:
+            for k, v in self._current.items():
+                self.samples[k].append(v)
+            self.samples["total"].append(self._end - self._start)
+            self.reruns += 1
+        self._current = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            if self._current is not None:
+                self._current[name] = self._current.get(name, 0.0) + now - start
+                self._end = now
+
+    def stats(self):
+        """
+        Count, mean and percentiles in ms of every phase that has run
+        """
+        stats = {}
+        for k, v in self.samples.items():
+            if not v:
+                continue
+            ms = np.array(v) * 1000
+            stats[k] = {
+                "n": len(ms),
+                "mean": float(ms.mean()),
+                **{f"p{q}": float(np.percentile(ms, q)) for q in PERCENTILES},
+                "max": float(ms.max()),
+            }
+        return stats
+
+    def to_json(self):
+        """
+        The window as JSON, serialized again only once a rerun was added
+        """
+        if self._json[0] != self.reruns:
+            self._json = (self.reruns, self._dump())
+        return self._json[1]
+
+    def _dump(self):
+        return json.dumps(
+            {
+                "window": self.samples["total"].maxlen,
+                "reruns": self.reruns,
+                "stats": self.stats(),
+                "samples": {k: [t * 1000 for t in v] for k, v in self.samples.items()},
+            },
+            indent=2,
+        )
+
+
+def start_rerun():
+    """
+    Start timing this rerun if diagnostics are on
+    """
+    if st.session_state.get("diagnostics", ENABLED):
+        st.session_state.setdefault("timer", RerunTimer()).start()
+    else:
+        st.session_state.pop("timer", None)
+
+
+def phase(name):
+    """
+    Context manager timing one phase of the rerun, a no-op with diagnostics off
+    """
+    timer = st.session_state.get("timer")
+    return nullcontext() if timer is None else timer.phase(name)
+
+
+def mk_diagnostics():
+    with st.expander("Diagnostics"):
+        st.toggle(
+            "Rerun Timing",
+            value=ENABLED,
+            key="diagnostics",
+            help="Time every phase of each rerun and show the percentiles "
+            f"over the last {WINDOW} reruns",
+        )
+
+        sizes = footprint()
+        sessions, runs = process_footprint()
+        st.caption(
+            "Session memory {:.0f} KiB ({}). {} sessions hold {:.0f} KiB of "
+            "finished runs.".format(
+                sum(sizes.values()) / 1024,
+                ", ".join(f"{k} {v / 1024:.0f}" for k, v in sizes.items()),
+                sessions,
+                runs / 1024,
+            )
+        )
+
+        timer = st.session_state.get("timer")
+        if timer is None or not timer.reruns:
+            return
+
+        st.dataframe(
+            pd.DataFrame(timer.stats()).T.round(2),
+            column_config={"n": st.column_config.NumberColumn(format="%d")},
+        )
+        st.caption(f"Times in ms, {timer.reruns} reruns so far")
+        # the window changes every rerun of the live loop, so it is only
+        # serialized while the run is paused
+        if st.session_state.get("auto_refresh"):
+            st.caption("Pause the simulation to download the timings")
+            return
+        st.download_button(
+            ":arrow_down: Download Timings",
+            data=timer.to_json(),
+            mime="application/json",
+            file_name="rerun_timings.json",
+        )
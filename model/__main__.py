@@ -0,0 +1,10 @@
+"""
+Batch runs of the scenarios in a manifest file, see `model.manifest`.
+
+    python -m model scenarios.yaml --out results.parquet
+"""
+
+from model.manifest import main
+
+if __name__ == "__main__":
+    main()
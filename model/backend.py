@@ -0,0 +1,334 @@
+"""
+Optional compiled backend.
+
+Set BIOREACTOR_BACKEND=numba (or pass backend="numba" to `simulate` and
+`run_batch`) to run the stepping loops through Numba. Without numba installed
+the pure Python reference implementation is used instead.
+
+Run `python -m model.backend` to check the compiled results against the
+reference.
+"""
+
+import importlib.util
+import os
+import sys
+import threading
+import warnings
+
+import numpy as np
+
+from model.run import kinetics, param, resolve, n_steps, STATE, COLUMNS
+
+# numba takes a while to import, so that is left until the compiled loops
+# are first used
+HAVE_NUMBA = importlib.util.find_spec("numba") is not None
+
+prange = range
+
+BACKENDS = ["python", "numba"]
+DEFAULT = os.environ.get("BIOREACTOR_BACKEND", "python")
+
+
+def get_backend(name=None):
+    """
+    Resolve a backend name. "auto" picks numba when it is installed.
+    """
+    name = name or DEFAULT
+    if name == "auto":
+        name = "numba" if HAVE_NUMBA else "python"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name!r}, expected one of {BACKENDS}")
+    if name == "numba" and not HAVE_NUMBA:
+        warnings.warn(
+            "numba is not installed, falling back to the python backend",
+            stacklevel=2,
+        )
+        return "python"
+    return name
+
+
+def advance(y, rates, feeds, dt, out):
+    """
+    Euler step of the mass balances from state y into out. Mirrors `step`.
+    """
+    X, Glc, Gln, Lac, Amm, P, V = y[0], y[1], y[2], y[3], y[4], y[5], y[6]
+    mu, kD, q_Glc, q_Gln, q_Lac, q_Amm, q_P = rates
+    Glc_F, Gln_F, F_Glc, F_Gln, F_B = feeds[0], feeds[1], feeds[2], feeds[3], feeds[4]
+    F = F_Glc + F_Gln + F_B
+
+    out[0] = X * (1 + dt * (mu - kD - F / V))
+    out[1] = max(
+        Glc + dt * (F_Glc * (Glc_F - Glc) / V - (F_Gln + F_B) * Glc / V - X * q_Glc),
+        0.0,
+    )
+    out[2] = max(
+        Gln + dt * (F_Gln * (Gln_F - Gln) / V - (F_Glc + F_B) * Gln / V - X * q_Gln),
+        0.0,
+    )
+    out[3] = Lac + dt * (q_Lac * X - F * Lac / V)
+    out[4] = Amm + dt * (q_Amm * X - F * Amm / V)
+    out[5] = P + dt * (q_P * X - F * P / V)
+    out[6] = V + dt * F
+
+
+def fill_row(y, t, feeds, p, row):
+    """
+    Write a full COLUMNS record for state y into row
+    """
+    for j in range(7):
+        row[j] = y[j]
+    row[7] = t
+    row[8] = feeds[2]
+    row[9] = feeds[3]
+    row[10] = feeds[4]
+    rates = kinetics(y[0], y[1], y[2], y[3], y[4], p)
+    for j in range(7):
+        row[11 + j] = rates[j]
+
+
+def trajectory(row0, p, feeds, dt):
+    """
+    Whole trajectory for an open loop feed table (n_steps x 5)
+    """
+    n = feeds.shape[0]
+    buf = np.empty((n + 1, row0.shape[0]))
+    buf[0] = row0
+    y = row0[:7].copy()
+    y_new = np.empty(7)
+    t = row0[7]
+
+    for i in range(n):
+        rates = kinetics(y[0], y[1], y[2], y[3], y[4], p)
+        advance(y, rates, feeds[i], dt, y_new)
+        y[:] = y_new
+        t += dt
+        fill_row(y, t, feeds[i], p, buf[i + 1])
+
+    return buf
+
+
+def row_step(row, p, feeds, dt):
+    """
+    One closed loop step of a full record
+    """
+    y = row[:7]
+    y_new = np.empty(7)
+    rates = kinetics(y[0], y[1], y[2], y[3], y[4], p)
+    advance(y, rates, feeds, dt, y_new)
+    new = np.empty(row.shape[0])
+    fill_row(y_new, row[7] + dt, feeds, p, new)
+    return new
+
+
+def batch_step(state, p, feeds, dt):
+    """
+    One step for every run; feeds is (n x 5)
+    """
+    new = np.empty_like(state)
+    for k in prange(state.shape[0]):
+        y = state[k]
+        rates = kinetics(y[0], y[1], y[2], y[3], y[4], p[k])
+        advance(y, rates, feeds[k], dt, new[k])
+    return new
+
+
+def batch(state, p, feeds, dt, record):
+    """
+    All steps for every run from an open loop feed table (n_steps x n x 5, or
+    n_steps x 1 x 5 when all runs share it). Each run is integrated on its
+    own, in parallel across runs.
+    """
+    steps, n, m = feeds.shape[0], state.shape[0], feeds.shape[1]
+    out = np.zeros((steps + 1 if record else 1, n, 10))
+
+    for k in prange(n):
+        y = state[k].copy()
+        y_new = np.empty(7)
+        f = k % m
+        if record:
+            out[0, k, :7] = y
+        for i in range(steps):
+            rates = kinetics(y[0], y[1], y[2], y[3], y[4], p[k])
+            advance(y, rates, feeds[i, f], dt, y_new)
+            y[:] = y_new
+            if record:
+                out[i + 1, k, :7] = y
+                out[i + 1, k, 7:] = feeds[i, f, 2:]
+        if not record:
+            out[0, k, :7] = y
+            if steps:
+                out[0, k, 7:] = feeds[steps - 1, f, 2:]
+
+    return out
+
+
+_compiled = False
+_lock = threading.Lock()
+
+
+def jit():
+    """
+    Wrap the loops above in numba.njit, once
+    """
+    global _compiled, prange
+    global kinetics, advance, fill_row, trajectory, row_step, batch_step, batch
+    with _lock:
+        if _compiled or not HAVE_NUMBA:
+            return
+        import numba
+
+        prange = numba.prange
+        kinetics = numba.njit(cache=True)(kinetics)
+        advance = numba.njit(cache=True)(advance)
+        fill_row = numba.njit(cache=True)(fill_row)
+        trajectory = numba.njit(cache=True)(trajectory)
+        row_step = numba.njit(cache=True)(row_step)
+        batch_step = numba.njit(cache=True, parallel=True)(batch_step)
+        batch = numba.njit(cache=True, parallel=True)(batch)
+        _compiled = True
+
+
+def feed_table(controller, t, dt):
+    """
+    Tabulate an open loop controller over the time grid, or None if the
+    controller needs the state
+    """
+    if not getattr(controller, "open_loop", False):
+        return None
+    return np.array([controller(t_i, None, dt) for t_i in t[:-1]], dtype="float64")
+
+
+def simulate(res, params, controller, t_max, dt):
+    """
+    Compiled counterpart of the Euler loop in `model.run.simulate`
+    """
+    jit()
+    p = np.asarray(resolve(params), dtype="float64")
+    row = np.array([res[k] for k in COLUMNS], dtype="float64")
+    n = n_steps(t_max, dt, res["t"])
+    t = res["t"] + np.arange(n + 1) * float(dt)
+
+    feeds = feed_table(controller, t, dt)
+    if feeds is not None:
+        buf = trajectory(row, p, feeds.reshape(n, 5), float(dt))
+    else:
+        buf = np.empty((n + 1, len(COLUMNS)))
+        buf[0] = row
+        for i in range(n):
+            res = dict(zip(COLUMNS, buf[i]))
+            f = np.array(controller(res["t"], res, dt), dtype="float64")
+            buf[i + 1] = row_step(buf[i], p, f, float(dt))
+
+    return buf.view([(k, "float64") for k in COLUMNS]).reshape(-1)
+
+
+def run_batch(state, p, feed, t, dt, record):
+    """
+    Compiled counterpart of the loop in `model.batch.run_batch`
+    """
+    jit()
+    steps, n = len(t) - 1, state.shape[0]
+    state = np.ascontiguousarray(state)
+    p = np.ascontiguousarray(p)
+
+    if getattr(feed, "open_loop", False):
+        table = [[np.asarray(f) for f in feed(t_i, None, dt)] for t_i in t[:-1]]
+        shared = all(f.ndim == 0 for row in table for f in row)
+        feeds = np.empty((steps, 1 if shared else n, 5))
+        for i, row in enumerate(table):
+            for j, f in enumerate(row):
+                feeds[i, :, j] = f
+        return batch(state, p, feeds, float(dt), record)
+
+    out = np.zeros((steps + 1 if record else 1, n, 10))
+    if record:
+        out[0, :, :7] = state
+    feeds = np.empty((n, 5))
+    for i in range(steps):
+        for j, f in enumerate(feed(t[i], dict(zip(STATE, state.T)), dt)):
+            feeds[:, j] = f
+        state = batch_step(state, p, feeds, float(dt))
+        if record:
+            out[i + 1, :, :7] = state
+            out[i + 1, :, 7:] = feeds[:, 2:]
+    if not record:
+        out[0, :, :7] = state
+        if steps:
+            out[0, :, 7:] = feeds[:, 2:]
+    return out
+
+
+def parity(backend="numba"):
+    """
+    Compare a backend against the python reference on a few scenarios.
+    Returns a dict of scenario name -> max relative error.
+    """
+    from model.run import simulate as run_simulate, GLC_F, GLN_F
+    from model.batch import run_batch as run_run_batch, init_batch
+    from model.control import BolusFeed, BOLUS_TIMES
+
+    def windows(t, res, dt):
+        return (
+            GLC_F,
+            GLN_F,
+            0.1 if 100 <= t <= 150 else 0.0,
+            0.05 if 50 <= t <= 200 else 0.0,
+            0.0,
+        )
+
+    windows.open_loop = True
+
+    def bang(t, res, dt):
+        glc_on = res["Glc"] + 0.5 < 20.0
+        return GLC_F, GLN_F, np.where(glc_on, 1.0, 0.0) * 1.0, 0.0, 0.0
+
+    bolus = BolusFeed(bolus_0=50.0, bolus_1=200.0, bolus_2=100.0, bolus_3=300.0)
+
+    rng = np.random.default_rng(0)
+    perturbed = {k: v * rng.uniform(0.8, 1.2) for k, v in param.items()}
+    initial = {"Glc_0": 10.0, "Gln_0": 2.0}
+
+    def rel(a, b):
+        a = np.asarray(a.tolist() if a.dtype.names else a, dtype="float64")
+        b = np.asarray(b.tolist() if b.dtype.names else b, dtype="float64")
+        return float(np.max(np.abs(a - b) / np.maximum(np.abs(b), 1e-12)))
+
+    errors = {}
+    for name, ctl, params, dt in [
+        ("batch culture", None, param, 1),
+        ("dosing windows", windows, param, 1),
+        ("dosing windows, dt=5", windows, perturbed, 5),
+        ("bang control", bang, perturbed, 2),
+        ("bolus feed", bolus, param, 1),
+        ("bolus feed, dt=5", bolus, perturbed, 5),
+    ]:
+        kw = {} if ctl is None else {"controller": ctl}
+        ref = run_simulate(initial, params, dt=dt, backend="python", **kw)
+        got = run_simulate(initial, params, dt=dt, backend=backend, **kw)
+        errors[name] = rel(got, ref)
+
+        state = init_batch(64, Glc_0=rng.uniform(5, 40, 64), Gln_0=2.0)
+        kw = {} if ctl is None else {"feed": ctl}
+        ref = run_run_batch(state, params, dt=dt, backend="python", **kw)[1]
+        got = run_run_batch(state, params, dt=dt, backend=backend, **kw)[1]
+        errors[name + " (batch)"] = rel(got, ref)
+
+    # the adaptive integrator splits steps at the bolus times and must still
+    # feed every bolus in full; the volume is linear in time, so it matches
+    ref = run_simulate(initial, param, bolus, dt=5, backend="python")
+    got = run_simulate(
+        initial, param, bolus, dt=5, method="RK45", breakpoints=BOLUS_TIMES
+    )
+    errors["bolus feed volume, adaptive"] = rel(got["V"], ref["V"])
+
+    return errors
+
+
+if __name__ == "__main__":
+    backend = sys.argv[1] if len(sys.argv) > 1 else "numba"
+    failed = False
+    for name, err in parity(backend).items():
+        ok = err <= 1e-9
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: max rel error {err:.2e}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,188 @@
+import numpy as np
+
+from model.run import param, Params, n_steps, no_control, STATE, FEEDS, RATES
+from model.backend import get_backend
+
+PARAMS = list(param)
+
+
+def param_array(params=None, n=1):
+    """
+    Stack parameter sets into an (n x N_param) array.
+
+    `params` may be a single dict or Params (broadcast to every run), a list
+    of them, or a dict of per-run arrays.
+    """
+    if params is None:
+        params = param
+
+    if isinstance(params, (np.ndarray, Params)):
+        return np.broadcast_to(params, (n, len(PARAMS))).astype("float64")
+
+    if isinstance(params, (list, tuple)):
+        return np.array(
+            [p if isinstance(p, Params) else [p[k] for k in PARAMS] for p in params],
+            dtype="float64",
+        )
+
+    p = np.empty((n, len(PARAMS)))
+    for j, k in enumerate(PARAMS):
+        p[:, j] = params.get(k, param[k])
+    return p
+
+
+def init_batch(
+    n=1,
+    X_0=2.0e5,
+    Glc_0=35.0,
+    Gln_0=4.0,
+    Lac_0=0.0,
+    Amm_0=0.0,
+    P_0=0.0,
+    V_0=1000.0,
+):
+    """
+    Build an (n x N_state) array of initial conditions. Takes the same
+    keyword arguments as `init_sim`, each either a scalar or a length n array.
+    """
+    state = np.empty((n, len(STATE)))
+    for j, v in enumerate([X_0, Glc_0, Gln_0, Lac_0, Amm_0, P_0, V_0]):
+        state[:, j] = v
+    return state
+
+
+def kinetics(state, p):
+    """
+    Vectorized rate laws. Returns an (n x N_rates) array ordered as RATES.
+    """
+    Glc, Gln, Lac, Amm = state[:, 1], state[:, 2], state[:, 3], state[:, 4]
+    (
+        mu_max,
+        Ks_Glc,
+        Ks_Gln,
+        Yx_Glc,
+        m_Glc,
+        qmax_Gln,
+        Kq_Gln,
+        Ylac_Glc,
+        Yamm_Gln,
+        alpha,
+        beta,
+        Kl1_Lac,
+        Kl2_Lac,
+        Kl1_Amm,
+        Kl2_Amm,
+        Kl3_Amm,
+    ) = p.T
+
+    rates = np.empty((state.shape[0], len(RATES)))
+
+    mu = (
+        (mu_max * Glc / (Ks_Glc + Glc))
+        * ((0.5 * Ks_Gln + Gln) / (Ks_Gln + Gln))
+        * (Kl1_Amm / (Kl1_Amm + Amm))
+        * (Kl1_Lac / (Kl1_Lac + Lac))
+    )
+
+    has_glc = Glc > 0
+    has_gln = Gln > 0
+    gln_high = Gln > 0.5
+
+    kD = 0.05 * (1 - Kl2_Amm / (Kl2_Amm + Amm)) + 0.05 * (1 - Kl2_Lac / (Kl2_Lac + Lac))
+    q_Glc = np.where(has_glc, mu / Yx_Glc + m_Glc, 0.0)
+    q_Gln = np.where(has_gln, qmax_Gln * Gln / (Kq_Gln + Gln), 0.0)
+
+    rates[:, 0] = mu
+    rates[:, 1] = np.where(has_glc, kD, 0.1)
+    rates[:, 2] = q_Glc
+    rates[:, 3] = q_Gln
+    rates[:, 4] = np.where(gln_high, Ylac_Glc * q_Glc, 0.0)
+    rates[:, 5] = np.where(gln_high, Yamm_Gln * q_Gln, 1e-8)
+    rates[:, 6] = (alpha * mu + beta) * Kl3_Amm / (Kl3_Amm + Amm)
+
+    return rates
+
+
+def step(state, rates, feeds, dt):
+    """
+    One explicit Euler step of the mass balances for every run. Mirrors `gen`.
+    """
+    Glc_F, Gln_F, F_Glc, F_Gln, F_B = feeds
+    X, Glc, Gln, Lac, Amm, P, V = state.T
+    mu, kD, q_Glc, q_Gln, q_Lac, q_Amm, q_P = rates.T
+
+    F = F_Glc + F_Gln + F_B
+    D = F / V
+
+    new = np.empty_like(state)
+    new[:, 0] = X * (1 + dt * (mu - kD - D))
+    new[:, 1] = Glc + dt * (
+        F_Glc * (Glc_F - Glc) / V - (F_Gln + F_B) * Glc / V - X * q_Glc
+    )
+    new[:, 2] = Gln + dt * (
+        F_Gln * (Gln_F - Gln) / V - (F_Glc + F_B) * Gln / V - X * q_Gln
+    )
+    new[:, 3] = Lac + dt * (q_Lac * X - D * Lac)
+    new[:, 4] = Amm + dt * (q_Amm * X - D * Amm)
+    new[:, 5] = P + dt * (q_P * X - D * P)
+    new[:, 6] = V + dt * F
+
+    # substrates cannot go negative
+    np.maximum(new[:, 1:3], 0, out=new[:, 1:3])
+
+    return new
+
+
+def run_batch(
+    state, params=None, feed=no_control, t_max=250, dt=1, record=True, backend=None
+):
+    """
+    Step N runs together from `state` (n x N_state) until t_max.
+
+    `feed(t, state, dt)` is called once per step with a dict of state columns
+    and returns (Glc_F, Gln_F, F_Glc, F_Gln, F_B), each a scalar or a length
+    n array.
+
+    Returns the time vector and, if `record`, an (n_steps+1 x n x N_cols)
+    array with STATE + FEEDS columns. Otherwise only the final row is kept.
+
+    `backend` picks the implementation of the stepping loop, see
+    `model.backend`.
+    """
+    state = np.array(state, dtype="float64", ndmin=2)
+    n = state.shape[0]
+    p = param_array(params, n)
+    steps = n_steps(t_max, dt)
+    t = np.arange(steps + 1) * float(dt)
+
+    if get_backend(backend) == "numba":
+        from model.backend import run_batch as compiled
+
+        return (t if record else t[-1:]), compiled(state, p, feed, t, dt, record)
+
+    cols = len(STATE) + len(FEEDS)
+    if record:
+        out = np.empty((steps + 1, n, cols))
+        out[0, :, : len(STATE)] = state
+        out[0, :, len(STATE) :] = 0.0
+    else:
+        out = np.empty((1, n, cols))
+
+    rates = kinetics(state, p)
+    feeds = None
+    for i in range(steps):
+        feeds = [
+            np.broadcast_to(f, (n,)) for f in feed(t[i], dict(zip(STATE, state.T)), dt)
+        ]
+        state = step(state, rates, feeds, dt)
+        rates = kinetics(state, p)
+        if record:
+            out[i + 1, :, : len(STATE)] = state
+            out[i + 1, :, len(STATE) :] = np.column_stack(feeds[2:])
+
+    if not record:
+        out[0, :, : len(STATE)] = state
+        out[0, :, len(STATE) :] = 0.0 if feeds is None else np.column_stack(feeds[2:])
+        t = t[-1:]
+
+    return t, out
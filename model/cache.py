@@ -0,0 +1,177 @@
+"""
+Content-addressed cache of simulated trajectories.
+
+Trajectories are stored under their scenario key (see `model.scenario`) in two
+tiers: a least recently used set in process memory, and .npy files in a
+directory that every session, process and replica pointing at it shares. Set
+BIOREACTOR_CACHE_DIR to choose the directory, or to an empty string to keep
+the cache in memory only. Once the files take more than BIOREACTOR_CACHE_MB
+megabytes, the least recently used ones are removed.
+"""
+
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+CACHE_DIR = os.environ.get(
+    "BIOREACTOR_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "bioreactor"),
+)
+DISK_BYTES = int(float(os.environ.get("BIOREACTOR_CACHE_MB", 1024)) * 2**20)
+
+
+class ResultCache:
+    """
+    Two tier trajectory cache. Values are the structured arrays returned by
+    `simulate` and must not be modified by callers.
+
+    `max_bytes` bounds the memory tier and `max_disk_bytes` the files. The
+    size of the directory is taken once and then counted up with every file
+    written; when it goes over, the directory is scanned again, since other
+    processes write to it too, and the files read or written longest ago are
+    removed until it is back to 3/4 of the budget.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_bytes=64 * 2**20, max_disk_bytes=DISK_BYTES):
+        self.path = path or None
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._nbytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.hits = {"memory": 0, "disk": 0, "miss": 0}
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + ".npy")
+
+    def _files(self):
+        """
+        (last use, size, path) of every cached file
+        """
+        files = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith(".npy"):
+                    file = os.path.join(root, name)
+                    try:
+                        stat = os.stat(file)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, file))
+        return files
+
+    def _wrote(self, nbytes):
+        """
+        Count a file written and trim the directory once over budget
+        """
+        with self._disk_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._files())
+            else:
+                self._disk_bytes += nbytes
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+            files = sorted(self._files())
+            total = sum(size for _, size, _ in files)
+            for _, size, file in files:
+                if total <= self.max_disk_bytes * 3 // 4:
+                    break
+                try:
+                    os.remove(file)
+                except OSError:
+                    # taken by another process already
+                    pass
+                total -= size
+            self._disk_bytes = total
+
+    def _remember(self, key, records):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = records
+            self._nbytes += records.nbytes
+            while self._nbytes > self.max_bytes and len(self._memory) > 1:
+                _, old = self._memory.popitem(last=False)
+                self._nbytes -= old.nbytes
+
+    def get(self, key):
+        """
+        Cached trajectory for key, or None
+        """
+        with self._lock:
+            records = self._memory.get(key)
+            if records is not None:
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return records
+
+        if self.path is not None:
+            try:
+                records = np.load(self._file(key), allow_pickle=False)
+            except (OSError, ValueError):
+                records = None
+            if records is not None:
+                records.flags.writeable = False
+                self._remember(key, records)
+                try:
+                    # mark it as recently used for the disk budget
+                    os.utime(self._file(key))
+                except OSError:
+                    pass
+                self.hits["disk"] += 1
+                return records
+
+        self.hits["miss"] += 1
+        return None
+
+    def put(self, key, records):
+        records = np.array(records)
+        records.flags.writeable = False
+        self._remember(key, records)
+
+        if self.path is None:
+            return
+        file = self._file(key)
+        if os.path.exists(file):
+            return
+        try:
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            # write then rename, so readers never see a partial file
+            tmp = f"{file}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, records, allow_pickle=False)
+            os.replace(tmp, file)
+            self._wrote(os.path.getsize(file))
+        except OSError:
+            # a read-only or full disk only costs the second tier
+            pass
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._memory.clear()
+            self._nbytes = 0
+        if disk and self.path is not None and os.path.isdir(self.path):
+            for root, _, files in os.walk(self.path):
+                for name in files:
+                    if name.endswith(".npy"):
+                        os.remove(os.path.join(root, name))
+            self._disk_bytes = None
+
+
+_default = None
+
+
+def default_cache():
+    """
+    The cache shared by everything in this process
+    """
+    global _default
+    if _default is None:
+        _default = ResultCache()
+    return _default
@@ -0,0 +1,323 @@
+"""
+Calibration of the kinetic constants against measured time series.
+
+Measurements are a table with a `t` column (h), any of the STATE columns
+(X, Glc, Gln, Lac, Amm, P, V) and optionally a `run` column when it holds
+several experiments. Each run starts from its first row, with the states it
+does not report taken from `initial` or the `init_sim` defaults. Missing
+values are skipped.
+
+    data = load_measurements("batch_runs.csv")
+    result = calibrate(data, ["mu_max", "Ks_Glc", "Yx_Glc", "Kl1_Amm"])
+    result["estimates"], result["ci"]
+
+The constants are fitted in log space by Levenberg-Marquardt on the residuals
+divided by `sigma`. Every Jacobian is one `run_batch` call that simulates the
+base point and all finite difference steps of all runs together, so a fit
+takes as many batch simulations as iterations.
+
+From the shell:
+
+    python -m model.calibrate batch_runs.csv --fit mu_max,Ks_Glc,Yx_Glc
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from model.run import param, resolve, n_steps, no_control, STATE, INITIAL
+from model.batch import PARAMS, init_batch, run_batch
+from model.export import format_of
+
+# fitted by default: growth, substrate affinity, yields and inhibition
+FIT = [
+    "mu_max",
+    "Ks_Glc",
+    "Yx_Glc",
+    "Ylac_Glc",
+    "Yamm_Gln",
+    "Kl1_Lac",
+    "Kl2_Lac",
+    "Kl1_Amm",
+    "Kl2_Amm",
+]
+
+
+def load_measurements(path):
+    """
+    Read measured time series from a .csv, .parquet or .arrow file
+    """
+    fmt = format_of(path)
+    if fmt == "csv":
+        data = pd.read_csv(path)
+    elif fmt == "parquet":
+        data = pd.read_parquet(path)
+    elif fmt == "arrow":
+        data = pd.read_feather(path)
+    else:
+        raise ValueError(f"Cannot read {path!r}, expected a .csv, .parquet or .arrow")
+
+    if "t" not in data:
+        raise ValueError(f"{path!r} has no t column")
+    if not any(k in data for k in STATE):
+        raise ValueError(f"{path!r} has none of the columns {STATE}")
+    return data
+
+
+def _runs(data):
+    if "run" in data:
+        return [run.sort_values("t") for _, run in data.groupby("run", sort=False)]
+    return [data.sort_values("t")]
+
+
+def calibrate(
+    data,
+    names=FIT,
+    params=None,
+    initial=None,
+    sigma=None,
+    controller=no_control,
+    dt=1,
+    level=0.95,
+    rel_step=1e-6,
+    max_iterations=100,
+    backend=None,
+):
+    """
+    Fit the constants `names` to a table of measurements (see the module
+    docstring). The other constants, and the starting values, come from
+    `params`.
+
+    `sigma` (column -> float) is the measurement error of each column, by
+    default the mean absolute value measured. The confidence intervals at
+    `level` come from the linearized covariance, scaled by the residual
+    variance, so they do not depend on the overall scale of `sigma`.
+
+    Returns a dict with the fitted Params, the estimates and their
+    confidence intervals and relative standard errors, the correlation of the
+    estimates, fit statistics and timings.
+    """
+    start = time.perf_counter()
+
+    names = list(names)
+    unknown = [k for k in names if k not in PARAMS]
+    if unknown:
+        raise ValueError(f"Unknown parameters {unknown}, expected some of {PARAMS}")
+    p0 = np.array(resolve(params), dtype="float64")
+    idx = [PARAMS.index(k) for k in names]
+    if np.any(p0[idx] <= 0):
+        zero = [k for k in names if p0[PARAMS.index(k)] <= 0]
+        raise ValueError(f"Starting values of {zero} must be positive")
+
+    runs = _runs(data)
+    measured = [k for k in STATE if k in data]
+
+    # initial state of each run from its first row
+    states = []
+    for run in runs:
+        first = run.iloc[0]
+        kw = dict(initial or {})
+        kw.update(
+            {
+                INITIAL[STATE.index(k)]: float(first[k])
+                for k in measured
+                if pd.notna(first[k])
+            }
+        )
+        states.append(init_batch(1, **kw)[0])
+    states = np.array(states)
+    R = len(runs)
+
+    # observations: value, run, column, grid step and interpolation weight
+    t_rel = [run["t"].to_numpy(dtype="float64") - run["t"].iloc[0] for run in runs]
+    steps = n_steps(max(t.max() for t in t_rel), dt)
+    if steps == 0:
+        raise ValueError("The measurements of every run are at a single time")
+
+    y, r_obs, j_obs, i_obs, w_obs = [], [], [], [], []
+    for r, (run, t) in enumerate(zip(runs, t_rel)):
+        for k in measured:
+            values = run[k].to_numpy(dtype="float64")
+            keep = ~np.isnan(values)
+            i = np.minimum(np.floor(t[keep] / dt), steps - 1).astype(int)
+            y.append(values[keep])
+            r_obs.append(np.full(keep.sum(), r))
+            j_obs.append(np.full(keep.sum(), STATE.index(k)))
+            i_obs.append(i)
+            w_obs.append(t[keep] / dt - i)
+    y, r_obs, j_obs, i_obs, w_obs = map(np.concatenate, (y, r_obs, j_obs, i_obs, w_obs))
+
+    sigma = dict(sigma or {})
+    for k in measured:
+        if k not in sigma:
+            scale = np.nanmean(np.abs(pd.concat([run[k] for run in runs])))
+            sigma[k] = scale if scale > 0 else 1.0
+    s = np.array([sigma[STATE[j]] for j in j_obs])
+
+    m, n = len(y), len(names)
+    if m <= n:
+        raise ValueError(f"{m} measurements are not enough to fit {n} parameters")
+
+    stats = {"simulations": 0, "batches": 0}
+
+    def predict(theta):
+        """
+        Model values at the observations for each row of log parameters,
+        an (m x B) array
+        """
+        B = len(theta)
+        P = np.repeat(p0[None], B, axis=0)
+        P[:, idx] = np.exp(theta)
+        _, out = run_batch(
+            np.tile(states, (B, 1)),
+            np.repeat(P, R, axis=0),
+            controller,
+            t_max=steps * dt,
+            dt=dt,
+            backend=backend,
+        )
+        stats["simulations"] += B * R
+        stats["batches"] += 1
+        out = out.reshape(steps + 1, B, R, -1)
+        return (
+            out[i_obs, :, r_obs, j_obs] * (1 - w_obs)[:, None]
+            + out[i_obs + 1, :, r_obs, j_obs] * w_obs[:, None]
+        )
+
+    def residuals(theta):
+        return (predict(theta[None])[:, 0] - y) / s
+
+    def jacobian(theta):
+        # base point and one forward step per parameter, simulated together
+        theta = np.vstack([theta, theta + rel_step * np.eye(n)])
+        pred = predict(theta)
+        return (pred[:, 1:] - pred[:, :1]) / rel_step / s[:, None]
+
+    from scipy.optimize import least_squares
+    from scipy.stats import t as student
+
+    fit = least_squares(
+        residuals,
+        np.log(p0[idx]),
+        jac=jacobian,
+        method="lm",
+        max_nfev=max_iterations * (n + 1),
+    )
+
+    # linearized covariance of the log parameters
+    dof = m - n
+    s2 = 2 * fit.cost / dof
+    J = fit.jac
+    cov = s2 * np.linalg.pinv(J.T @ J)
+    se = np.sqrt(np.maximum(np.diag(cov), 0))
+    z = student.ppf((1 + level) / 2, dof)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = cov / np.outer(se, se)
+
+    estimates = np.exp(fit.x)
+    p = p0.copy()
+    p[idx] = estimates
+
+    final = (predict(fit.x[None])[:, 0] - y) / s
+    rmse = {
+        STATE[j]: float(np.sqrt(np.mean((final * s)[j_obs == j] ** 2)))
+        for j in np.unique(j_obs)
+    }
+
+    return {
+        "params": resolve(dict(zip(PARAMS, p))),
+        "start": dict(zip(names, map(float, p0[idx]))),
+        "estimates": dict(zip(names, map(float, estimates))),
+        "ci": {
+            k: (float(np.exp(x - z * e)), float(np.exp(x + z * e)))
+            for k, x, e in zip(names, fit.x, se)
+        },
+        # standard error of the log, i.e. relative to the estimate
+        "rse": dict(zip(names, map(float, se))),
+        "correlation": pd.DataFrame(corr, index=names, columns=names),
+        "cost": float(2 * fit.cost),
+        "rmse": rmse,
+        "observations": m,
+        "level": level,
+        "success": bool(fit.success),
+        "message": fit.message,
+        "iterations": int(fit.njev or 0),
+        "elapsed": time.perf_counter() - start,
+        **stats,
+    }
+
+
+def summary(result):
+    """
+    Table of the estimates with their confidence intervals
+    """
+    names = list(result["estimates"])
+    return pd.DataFrame(
+        {
+            "start": [result["start"][k] for k in names],
+            "estimate": [result["estimates"][k] for k in names],
+            "low": [result["ci"][k][0] for k in names],
+            "high": [result["ci"][k][1] for k in names],
+            "rse %": [100 * result["rse"][k] for k in names],
+        },
+        index=pd.Index(names, name="parameter"),
+    )
+
+
+def _pairs(items):
+    return {k: float(v) for k, v in (item.split("=", 1) for item in items or [])}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m model.calibrate", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("data", help=".csv, .parquet or .arrow measurements")
+    parser.add_argument(
+        "--fit", default=",".join(FIT), help="comma separated parameters to fit"
+    )
+    parser.add_argument(
+        "--set", action="append", metavar="KEY=VALUE", help="starting or fixed value"
+    )
+    parser.add_argument(
+        "--initial", action="append", metavar="KEY=VALUE", help="e.g. V_0=1000"
+    )
+    parser.add_argument(
+        "--sigma", action="append", metavar="COLUMN=VALUE", help="measurement error"
+    )
+    parser.add_argument("--dt", type=float, default=1)
+    parser.add_argument("--level", type=float, default=0.95)
+    parser.add_argument("--backend", default=None)
+    args = parser.parse_args(argv)
+
+    result = calibrate(
+        load_measurements(args.data),
+        [k.strip() for k in args.fit.split(",") if k.strip()],
+        params=dict(param, **_pairs(args.set)),
+        initial=_pairs(args.initial),
+        sigma=_pairs(args.sigma),
+        dt=args.dt,
+        level=args.level,
+        backend=args.backend,
+    )
+
+    print(summary(result).to_string(float_format="{:.4g}".format))
+    print(
+        "{} observations, weighted SSR {:.4g}, {} iterations, {} simulations in "
+        "{:.2f} s{}".format(
+            result["observations"],
+            result["cost"],
+            result["iterations"],
+            result["simulations"],
+            result["elapsed"],
+            "" if result["success"] else f" ({result['message']})",
+        ),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+"""
+Feed control policies.
+
+A controller is called as `controller(t, res, dt)` with the current state
+`res`, a dict with (at least) the STATE keys holding scalars for a single
+`simulate` run or length n arrays for an n-run `run_batch`, and returns the
+feeds (Glc_F, Gln_F, F_Glc, F_Gln, F_B) for the next step, each a scalar or
+a length n array. Every setting can also be a scalar or a length n array, so
+the same policy drives the app, headless runs and batched sweeps.
+
+    controller = make_controller("Bang Control", Glc_SP=25.0)
+    simulate(controller=controller)
+"""
+
+import math
+import time
+
+import numpy as np
+
+from model.run import GLC_F, GLN_F, STATE
+from model.batch import kinetics, step, param_array
+
+BOLUS_TIMES = [1.0, 25.0, 50.0, 100.0]
+DEADBAND = 0.5
+
+
+class Controller:
+    """
+    Base class of the control policies.
+
+    Open loop controllers do not look at the state, so they may be called
+    with res=None and their feeds tabulated ahead of time. Controllers with
+    memory (PID, MPC) start over in `reset`, which is also done automatically
+    when time runs backwards, i.e. when they are reused for a new run.
+    """
+
+    open_loop = False
+
+    def __call__(self, t, res, dt):
+        raise NotImplementedError
+
+    def reset(self):
+        pass
+
+
+class BolusFeed(Controller):
+    """
+    Concentrated glucose bolus (mL) fed over the step that contains each
+    bolus time. The flow is the volume over the length of that step, so the
+    whole bolus goes in however the steps fall, e.g. when `integrate` splits
+    a step at the bolus time.
+    """
+
+    open_loop = True
+
+    def __init__(
+        self, bolus_0=0.0, bolus_1=0.0, bolus_2=0.0, bolus_3=0.0, times=BOLUS_TIMES
+    ):
+        self.volumes = [bolus_0, bolus_1, bolus_2, bolus_3]
+        self.times = times
+
+    def __call__(self, t, res, dt):
+        F_Glc = 0.0
+        Glc_F = GLC_F
+        # walk backwards so the earliest matching bolus time wins
+        for T, vol in reversed(list(zip(self.times, self.volumes))):
+            hit = t <= T < t + dt
+            F_Glc = np.where(hit, np.divide(vol, 1000 * dt), F_Glc)
+            Glc_F = np.where(hit, GLC_F * 10, Glc_F)
+        return Glc_F, GLN_F, F_Glc, 0.0, 0.0
+
+
+class ContinuousFeed(Controller):
+    """
+    Constant feeds (L/h) switched on inside the glucose and glutamine dosing
+    windows (h)
+    """
+
+    open_loop = True
+
+    def __init__(
+        self,
+        F_Glc=0.0,
+        F_Gln=0.0,
+        t0_glc=175.0,
+        tn_glc=225.0,
+        t0_gln=175.0,
+        tn_gln=225.0,
+    ):
+        self.F_Glc, self.F_Gln = F_Glc, F_Gln
+        self.t_glc = (t0_glc, tn_glc)
+        self.t_gln = (t0_gln, tn_gln)
+
+    def __call__(self, t, res, dt):
+        return (
+            GLC_F,
+            GLN_F,
+            np.where((self.t_glc[0] <= t) & (t <= self.t_glc[1]), self.F_Glc, 0.0),
+            np.where((self.t_gln[0] <= t) & (t <= self.t_gln[1]), self.F_Gln, 0.0),
+            0.0,
+        )
+
+
+class BangControl(Controller):
+    """
+    On/off feeding whenever a substrate drops a deadband below its setpoint
+    """
+
+    def __init__(
+        self,
+        F_Glc=1.0,
+        F_Gln=1.0,
+        Glc_SP=20.0,
+        Gln_SP=0.0,
+        Glc_DB=DEADBAND,
+        Gln_DB=DEADBAND,
+    ):
+        self.F_Glc, self.F_Gln = F_Glc, F_Gln
+        self.Glc_SP, self.Gln_SP = Glc_SP, Gln_SP
+        self.Glc_DB, self.Gln_DB = Glc_DB, Gln_DB
+
+    def __call__(self, t, res, dt):
+        return (
+            GLC_F,
+            GLN_F,
+            np.where(res["Glc"] + self.Glc_DB < self.Glc_SP, self.F_Glc, 0.0),
+            np.where(res["Gln"] + self.Gln_DB < self.Gln_SP, self.F_Gln, 0.0),
+            0.0,
+        )
+
+
+class PID(Controller):
+    """
+    PID feeding toward the glucose and glutamine setpoints (mM). The gains
+    are in L/h per mM and the feeds are clipped to [0, F_Glc] and [0, F_Gln];
+    the integral term stops growing while a feed is saturated.
+    """
+
+    def __init__(
+        self,
+        Glc_SP=20.0,
+        Gln_SP=2.0,
+        Kp=0.1,
+        Ki=0.01,
+        Kd=0.0,
+        F_Glc=1.0,
+        F_Gln=1.0,
+    ):
+        self.setpoints = (Glc_SP, Gln_SP)
+        self.limits = (F_Glc, F_Gln)
+        self.Kp, self.Ki, self.Kd = Kp, Ki, Kd
+        self.reset()
+
+    def reset(self):
+        self._t = None
+        self._integral = [0.0, 0.0]
+        self._error = [None, None]
+
+    def __call__(self, t, res, dt):
+        if self._t is not None and t < self._t:
+            self.reset()
+        self._t = t
+
+        feeds = []
+        for i, k in enumerate(["Glc", "Gln"]):
+            error = self.setpoints[i] - np.asarray(res[k], dtype="float64")
+            previous = error if self._error[i] is None else self._error[i]
+            integral = self._integral[i] + error * dt
+
+            u = self.Kp * error + self.Ki * integral + self.Kd * (error - previous) / dt
+            F = np.clip(u, 0.0, self.limits[i])
+
+            # anti-windup: keep the old integral where the feed is saturated
+            self._integral[i] = np.where(u == F, integral, self._integral[i])
+            self._error[i] = error
+            feeds.append(F)
+
+        return GLC_F, GLN_F, feeds[0], feeds[1], 0.0
+
+
+class MPC(Controller):
+    """
+    Model predictive control on the Euler model.
+
+    Every `interval` hours, `samples` feed profiles per run are rolled
+    forward over the `horizon` from the current state, all runs and profiles
+    in one batch. A profile holds (F_Glc, F_Gln) constant over each interval
+    of the horizon, and the first move of the cheapest one is applied until
+    the next decision. The cost is the squared relative distance of Glc and
+    Gln to their setpoints plus `feed_weight` times the relative feed rates.
+
+    Profiles are drawn around the previous solution shifted by one interval
+    (warm start) and refined cross-entropy style for up to `rounds` rounds.
+    With a `budget` (s), refinement stops once another round would not fit
+    in it. The wall time of every decision is kept in `timings`.
+
+    `params` are the kinetic constants of the internal model. The settings
+    from `horizon` on are shared by all runs.
+    """
+
+    uses_model = True
+
+    def __init__(
+        self,
+        Glc_SP=20.0,
+        Gln_SP=2.0,
+        F_Glc=1.0,
+        F_Gln=1.0,
+        horizon=24.0,
+        interval=4.0,
+        samples=64,
+        rounds=4,
+        budget=None,
+        feed_weight=0.01,
+        params=None,
+        seed=0,
+    ):
+        self.setpoints = (Glc_SP, Gln_SP)
+        self.limits = (F_Glc, F_Gln)
+        self.horizon, self.interval = horizon, interval
+        self.blocks = max(round(horizon / interval), 1)
+        self.samples, self.rounds = int(samples), int(rounds)
+        if self.samples < 1 or self.rounds < 1:
+            raise ValueError("MPC needs at least one sample and one round")
+        self.budget = budget
+        self.feed_weight = feed_weight
+        self.params = params
+        self.seed = seed
+        self.reset()
+
+    def reset(self):
+        self._t = None
+        self._next = -np.inf
+        self._move = (0.0, 0.0)
+        self._plan = None
+        self._rng = np.random.default_rng(self.seed)
+        self.timings = []
+        self.rounds_done = []
+
+    def rollout(self, state, plans, dt):
+        """
+        Cost of each profile in an (n x S x blocks x 2) array of feeds, from
+        an (n x N_state) state. Returns an (n x S) array.
+        """
+        n, S = plans.shape[:2]
+        x = np.repeat(state, S, axis=0)
+        p = np.repeat(param_array(self.params, n), S, axis=0)
+        plans = plans.reshape(n * S, self.blocks, 2)
+
+        SP = [np.repeat(np.broadcast_to(sp, (n,)), S) for sp in self.setpoints]
+        scale = [np.maximum(sp, 1.0) for sp in SP]
+        limits = [
+            np.maximum(np.repeat(np.broadcast_to(f, (n,)), S), 1e-12)
+            for f in self.limits
+        ]
+
+        steps = max(math.ceil(self.horizon / dt), 1)
+        cost = np.zeros(n * S)
+        for i in range(steps):
+            b = min(i * self.blocks // steps, self.blocks - 1)
+            F_Glc, F_Gln = plans[:, b, 0], plans[:, b, 1]
+            x = step(x, kinetics(x, p), (GLC_F, GLN_F, F_Glc, F_Gln, 0.0), dt)
+            cost += dt * (
+                ((x[:, 1] - SP[0]) / scale[0]) ** 2
+                + ((x[:, 2] - SP[1]) / scale[1]) ** 2
+                + self.feed_weight * (F_Glc / limits[0] + F_Gln / limits[1])
+            )
+        return cost.reshape(n, S)
+
+    def solve(self, state, dt):
+        """
+        Best feed profile for each run, an (n x blocks x 2) array
+        """
+        start = time.perf_counter()
+        n = len(state)
+        limits = np.stack(
+            [np.broadcast_to(f, (n,)) for f in self.limits], axis=-1
+        ).astype("float64")[:, None, :]
+
+        if self._plan is None or len(self._plan) != n:
+            mean = np.broadcast_to(limits / 2, (n, self.blocks, 2)).copy()
+        else:
+            # warm start: the previous plan moved on by one interval
+            mean = np.concatenate([self._plan[:, 1:], self._plan[:, -1:]], axis=1)
+        std = np.broadcast_to(limits / 2, mean.shape).copy()
+
+        best = mean.copy()
+        best_cost = np.full(n, np.inf)
+        rows = np.arange(n)
+        n_elite = max(self.samples // 8, 2)
+
+        done = 0
+        for _ in range(self.rounds):
+            t_round = time.perf_counter()
+            noise = self._rng.standard_normal((n, self.samples, self.blocks, 2))
+            plans = mean[:, None] + std[:, None] * noise
+            # the centre of the distribution is always a candidate
+            plans[:, 0] = mean
+            np.clip(plans, 0.0, limits[:, None], out=plans)
+
+            cost = self.rollout(state, plans, dt)
+            order = np.argsort(cost, axis=1)
+            better = cost[rows, order[:, 0]] < best_cost
+            best[better] = plans[rows, order[:, 0]][better]
+            best_cost = np.minimum(best_cost, cost[rows, order[:, 0]])
+
+            elite = plans[rows[:, None], order[:, :n_elite]]
+            mean, std = elite.mean(axis=1), elite.std(axis=1)
+            done += 1
+
+            now = time.perf_counter()
+            if self.budget is not None and now - start + (now - t_round) > self.budget:
+                break
+
+        self.timings.append(time.perf_counter() - start)
+        self.rounds_done.append(done)
+        return best
+
+    def latency(self):
+        """
+        Decision times in ms and the share of decisions within the budget
+        """
+        ms = np.array(self.timings) * 1000
+        if not len(ms):
+            return {}
+        return {
+            "decisions": len(ms),
+            "last": float(ms[-1]),
+            "p50": float(np.percentile(ms, 50)),
+            "p95": float(np.percentile(ms, 95)),
+            "max": float(ms.max()),
+            "rounds": float(np.mean(self.rounds_done)),
+            "within_budget": (
+                None
+                if self.budget is None
+                else float(np.mean(ms <= self.budget * 1000))
+            ),
+        }
+
+    def __call__(self, t, res, dt):
+        if self._t is not None and t < self._t:
+            self.reset()
+        self._t = t
+
+        if t >= self._next:
+            scalar = np.ndim(res["X"]) == 0
+            state = np.column_stack([np.atleast_1d(res[k]) for k in STATE])
+            self._plan = self.solve(state, dt)
+            move = self._plan[:, 0, 0], self._plan[:, 0, 1]
+            self._move = tuple(float(m[0]) for m in move) if scalar else move
+            self._next = t + self.interval - 1e-9
+
+        return GLC_F, GLN_F, self._move[0], self._move[1], 0.0
+
+
+CONTROLLERS = {
+    "Bolus Feed": BolusFeed,
+    "Continuous Feed": ContinuousFeed,
+    "Bang Control": BangControl,
+    "PID Control": PID,
+    "MPC": MPC,
+}
+
+# Control schemes by name
+MODES = list(CONTROLLERS)
+
+
+def make_controller(mode, params=None, **settings):
+    """
+    Build the controller for a control scheme. `params` are handed to
+    controllers that simulate the model themselves.
+    """
+    if mode not in CONTROLLERS:
+        raise ValueError(f"Unknown control mode {mode!r}, expected one of {MODES}")
+    if getattr(CONTROLLERS[mode], "uses_model", False):
+        settings.setdefault("params", params)
+    return CONTROLLERS[mode](**settings)
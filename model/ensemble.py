@@ -0,0 +1,125 @@
+"""
+Ensembles of runs under parameter uncertainty.
+
+Each member draws its kinetic constants around the nominal ones, with a
+log-normal spread of `cv`, and follows the flows fed to the live run, so the
+ensemble shows where the culture could be under the same operator actions.
+All members are stepped together as one vectorized batch, and each step only
+reduces the new state of the members to its quantiles, so the bands grow one
+row at a time and the member histories are never kept.
+
+    ensemble = Ensemble(initial, params, n=200, cv=0.1)
+    ensemble.sync(data)             # catch up with the rows of a Trajectory
+    low, median, high = ensemble.band("X")
+"""
+
+import numpy as np
+
+from model.run import resolve, GLC_F, GLN_F, STATE
+from model.batch import PARAMS, init_batch, kinetics, step
+from model.control import make_controller
+
+# columns with bands and the quantiles that bound them
+BANDED = ["X", "Glc", "Gln", "Lac", "Amm", "P"]
+QUANTILES = (0.05, 0.5, 0.95)
+
+
+def sample_params(params=None, n=200, cv=0.1, seed=None):
+    """
+    (n x N_param) array of constants, each the nominal value times a
+    log-normal factor with a relative spread of about `cv`
+    """
+    rng = np.random.default_rng(seed)
+    nominal = np.asarray(resolve(params), dtype="float64")
+    return nominal * np.exp(cv * rng.standard_normal((n, len(PARAMS))))
+
+
+def schedule_concentrations(schedule, params=None):
+    """
+    Feed concentrations (Glc_F, Gln_F) at time t of a control schedule, as
+    `concentrations(t, dt)`. Only open loop schemes (the glucose bolus)
+    change them, so only those are asked.
+    """
+    controllers = {}
+
+    def concentrations(t, dt):
+        active = [k for k, entry in enumerate(schedule) if entry[0] <= t + 1e-9]
+        if not active:
+            return GLC_F, GLN_F
+        k = active[-1]
+        if k not in controllers:
+            _, mode, settings = schedule[k][:3]
+            controller = make_controller(mode, params=params, **settings)
+            controllers[k] = controller if controller.open_loop else None
+        if controllers[k] is None:
+            return GLC_F, GLN_F
+        Glc_F, Gln_F = controllers[k](t, None, dt)[:2]
+        return float(Glc_F), float(Gln_F)
+
+    return concentrations
+
+
+class Ensemble:
+    """
+    Members stepped along a live trajectory, with the quantiles of each
+    BANDED column kept for every row it has caught up with
+    """
+
+    def __init__(self, initial, params=None, n=200, cv=0.1, seed=None, capacity=256):
+        self.state = init_batch(n, **initial)
+        self.p = sample_params(params, n, cv, seed)
+        self.rates = kinetics(self.state, self.p)
+        self._bands = np.empty((capacity, len(BANDED), len(QUANTILES)))
+        self._n = 0
+        self._columns = [STATE.index(k) for k in BANDED]
+        self._record()
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def nbytes(self):
+        return (
+            self.state.nbytes + self.p.nbytes + self.rates.nbytes + self._bands.nbytes
+        )
+
+    def _record(self):
+        if self._n == len(self._bands):
+            self._bands = np.concatenate([self._bands, np.empty_like(self._bands)])
+        self._bands[self._n] = np.quantile(
+            self.state[:, self._columns], QUANTILES, axis=0
+        ).T
+        self._n += 1
+
+    def advance(self, feeds, dt):
+        """
+        Step every member with feeds (Glc_F, Gln_F, F_Glc, F_Gln, F_B)
+        """
+        self.state = step(self.state, self.rates, feeds, dt)
+        self.rates = kinetics(self.state, self.p)
+        self._record()
+
+    def sync(self, data, concentrations=None):
+        """
+        Step along the rows of `data` (a Trajectory) not seen yet. Row i+1
+        holds the flows of the step from row i, fed at the concentrations
+        given by `concentrations(t, dt)`, constant by default.
+        """
+        t = data["t"]
+        for i in range(self._n, len(data)):
+            dt = t[i] - t[i - 1]
+            Glc_F, Gln_F = (
+                (GLC_F, GLN_F)
+                if concentrations is None
+                else concentrations(t[i - 1], dt)
+            )
+            feeds = (Glc_F, Gln_F, data["F_Glc"][i], data["F_Gln"][i], data["F_B"][i])
+            self.advance(feeds, dt)
+        return self
+
+    def band(self, column, start=0):
+        """
+        Low, median and high quantile of a column from row `start` on
+        """
+        bands = self._bands[start : self._n, BANDED.index(column)]
+        return tuple(bands.T)
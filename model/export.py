@@ -0,0 +1,117 @@
+"""
+Export of trajectories and sweep tables.
+
+    payload = to_bytes(frame, "parquet")
+
+    with ChunkWriter("sweep.parquet") as out:
+        for chunk in iter_sweep(design):
+            out.write(chunk)
+
+Parquet and Arrow go through pyarrow, which pandas needs for them anyway.
+"""
+
+import io
+import os
+
+import numpy as np
+
+# format -> MIME type
+FORMATS = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+    "npz": "application/octet-stream",
+}
+
+# formats ChunkWriter can append to
+STREAMING = ["csv", "parquet", "arrow"]
+
+
+def _table(frame):
+    import pyarrow as pa
+
+    return pa.Table.from_pandas(frame, preserve_index=False)
+
+
+def to_bytes(frame, fmt="csv"):
+    """
+    Serialize a DataFrame (without its index) in one of FORMATS
+    """
+    if fmt == "csv":
+        return frame.to_csv(index=False).encode("utf-8")
+
+    buf = io.BytesIO()
+    if fmt == "parquet":
+        frame.to_parquet(buf, index=False)
+    elif fmt == "arrow":
+        import pyarrow as pa
+
+        table = _table(frame)
+        with pa.ipc.new_file(buf, table.schema) as writer:
+            writer.write_table(table)
+    elif fmt == "npz":
+        np.savez_compressed(buf, **{k: frame[k].to_numpy() for k in frame.columns})
+    else:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {list(FORMATS)}")
+    return buf.getvalue()
+
+
+def format_of(path):
+    return os.path.splitext(path)[1].lstrip(".").lower()
+
+
+class ChunkWriter:
+    """
+    Appends DataFrame chunks with the same columns to a .csv, .parquet or
+    .arrow file, so a large table never has to be held in memory at once
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fmt = format_of(path)
+        if self.fmt not in STREAMING:
+            raise ValueError(
+                f"Cannot stream to {path!r}, use one of the extensions {STREAMING}"
+            )
+        self.rows = 0
+        self._sink = None
+        self._writer = None
+
+    def write(self, frame):
+        if self.fmt == "csv":
+            frame.to_csv(
+                self.path,
+                mode="a" if self.rows else "w",
+                header=not self.rows,
+                index=False,
+            )
+        else:
+            table = _table(frame)
+            if self._writer is None:
+                self._open(table.schema)
+            self._writer.write_table(table)
+        self.rows += len(frame)
+
+    def _open(self, schema):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.fmt == "parquet":
+            self._writer = pq.ParquetWriter(self.path, schema)
+        else:
+            self._sink = pa.OSFile(self.path, "wb")
+            self._writer = pa.ipc.new_file(self._sink, schema)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,312 @@
+"""
+Batch runs of the scenarios listed in a manifest file.
+
+A YAML or JSON manifest is a list of scenarios, or a mapping with the
+`scenarios` list and `defaults` that every scenario starts from:
+
+    defaults: {dt: 1, t_max: 250, mode: Bang Control}
+    scenarios:
+      - name: low_setpoint
+        initial: {X_0: 2.0e5, Glc_0: 35}
+        settings: {Glc_SP: 15}
+      - name: fast_growth
+        params: {mu_max: 0.06}
+        schedule: [[0, Continuous Feed, {F_Glc: 0.5}], [100, Bang Control, {}]]
+
+A schedule entry may end with its own step time, [t, mode, settings, dt].
+
+A CSV manifest has one scenario per row: `name`, `mode`, `dt` and `t_max`
+columns, `init_sim` keyword arguments (X_0, Glc_0, ...) and `param` names,
+and any other column is a setting of the control scheme. Empty cells keep
+the default.
+
+    python -m model scenarios.yaml --out results.parquet --summary summary.csv
+
+Scenarios run in a process pool. Each finished trajectory is saved under
+its scenario key in a checkpoint directory (next to the output by default),
+so an interrupted batch resumes where it stopped and an edited scenario is
+run again. The output is one columnar table (.csv, .parquet or .arrow) with
+a `scenario` column, written from the checkpoints in manifest order.
+"""
+
+import argparse
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from model.run import param, INITIAL, STATE
+from model.cache import ResultCache, default_cache
+from model.control import MODES
+from model.export import ChunkWriter, STREAMING, format_of, to_bytes
+from model.scenario import scenario, scenario_key, simulate_scenario
+from model.sweep import OUTPUTS, summarize
+
+MANIFESTS = ["yaml", "yml", "json", "csv"]
+
+# scenario keys that are not control settings in a CSV manifest
+RESERVED = ["name", "mode", "dt", "t_max"]
+
+
+def _read(path):
+    fmt = format_of(path)
+    if fmt in ("yaml", "yml"):
+        import yaml
+
+        with open(path) as f:
+            return yaml.safe_load(f)
+    if fmt == "json":
+        import json
+
+        with open(path) as f:
+            return json.load(f)
+    if fmt == "csv":
+        rows = pd.read_csv(path).to_dict("records")
+        return [_from_row(row) for row in rows]
+    raise ValueError(f"Cannot read {path!r}, expected one of {MANIFESTS}")
+
+
+def _from_row(row):
+    """
+    Scenario entry of one CSV row
+    """
+    entry = {"initial": {}, "params": {}, "settings": {}}
+    for k, v in row.items():
+        if isinstance(v, float) and math.isnan(v):
+            continue
+        if k in RESERVED:
+            entry[k] = v
+        elif k in INITIAL:
+            entry["initial"][k] = v
+        elif k in param:
+            entry["params"][k] = v
+        else:
+            entry["settings"][k] = v
+    return entry
+
+
+def _merge(defaults, entry):
+    merged = dict(defaults, **entry)
+    for k in ("initial", "params", "settings"):
+        merged[k] = dict(defaults.get(k) or {}, **(entry.get(k) or {}))
+    return merged
+
+
+def load_manifest(path):
+    """
+    (name, scenario dict) of every scenario in a manifest file
+    """
+    manifest = _read(path)
+    if isinstance(manifest, dict):
+        defaults, entries = manifest.get("defaults") or {}, manifest.get("scenarios")
+    else:
+        defaults, entries = {}, manifest
+    if not entries:
+        raise ValueError(f"{path!r} lists no scenarios")
+
+    scenarios = []
+    for i, entry in enumerate(entries):
+        entry = _merge(defaults, entry)
+        name = str(entry.get("name", f"scenario_{i + 1}"))
+        schedule = entry.get("schedule")
+        if schedule is None:
+            schedule = [[0.0, entry.get("mode", "Continuous Feed"), entry["settings"]]]
+        for item in schedule:
+            if not isinstance(item, (list, tuple)) or len(item) not in (3, 4):
+                raise ValueError(
+                    f"{name}: schedule entries are [t, mode, settings] or "
+                    f"[t, mode, settings, dt], got {item!r}"
+                )
+            if item[1] not in MODES:
+                raise ValueError(
+                    f"{name}: unknown control mode {item[1]!r}, "
+                    f"expected one of {MODES}"
+                )
+        unknown = [k for k in entry["initial"] if k not in INITIAL]
+        unknown += [k for k in entry["params"] if k not in param]
+        if unknown:
+            raise ValueError(
+                f"{name}: unknown initial conditions or constants {unknown}"
+            )
+        try:
+            # YAML reads 2.0e5 as a string
+            schedule = [
+                [
+                    float(item[0]),
+                    item[1],
+                    {k: float(v) for k, v in (item[2] or {}).items()},
+                    *map(float, item[3:]),
+                ]
+                for item in schedule
+            ]
+            scenarios.append(
+                (
+                    name,
+                    scenario(
+                        {k: float(v) for k, v in entry["initial"].items()},
+                        {k: float(v) for k, v in entry["params"].items()},
+                        schedule,
+                        dt=float(entry.get("dt", 1)),
+                        t_max=float(entry.get("t_max", 250)),
+                    ),
+                )
+            )
+        except ValueError as e:
+            raise ValueError(f"{name}: {e}") from None
+
+    names = [name for name, _ in scenarios]
+    duplicated = sorted({k for k in names if names.count(k) > 1})
+    if duplicated:
+        raise ValueError(f"Scenario names must be unique, repeated: {duplicated}")
+    return scenarios
+
+
+def _summary(records):
+    out = np.stack([records[k] for k in STATE], axis=1)[:, None, :]
+    return {k: float(v[0]) for k, v in summarize(records["t"], out).items()}
+
+
+def run_scenario(scenario, checkpoint):
+    """
+    Simulate a scenario unless its checkpoint exists, runs in a worker.
+    Returns whether it was simulated and its figures of merit.
+    """
+    store = ResultCache(checkpoint, max_bytes=0)
+    key = scenario_key(scenario)
+    records = store.get(key)
+    simulated = records is None
+    if simulated:
+        records = simulate_scenario(scenario, default_cache())
+        store.put(key, records)
+    return simulated, _summary(records)
+
+
+class Progress:
+    """
+    One status line on stderr, redrawn in place on a terminal
+    """
+
+    def __init__(self, total, file=sys.stderr):
+        self.total = total
+        self.file = file
+        self.start = time.perf_counter()
+        self.tty = file.isatty()
+        self.shown = -1
+
+    def update(self, done, resumed=0):
+        elapsed = time.perf_counter() - self.start
+        # only the runs simulated now tell how long the rest will take
+        rate = (done - resumed) / elapsed if elapsed > 0 else 0
+        left = self.total - done
+        eta = left / rate if rate > 0 else (0.0 if not left else float("nan"))
+        line = "{}/{} scenarios ({} from checkpoints), {:.1f} s, ETA {:.1f} s".format(
+            done, self.total, resumed, elapsed, eta
+        )
+        if self.tty:
+            print("\r" + line, end="\n" if done == self.total else "", file=self.file)
+        elif done * 10 // self.total > self.shown or done == self.total:
+            # every 10% when logging to a file
+            self.shown = done * 10 // self.total
+            print(line, file=self.file)
+        self.file.flush()
+
+
+def run_manifest(
+    scenarios,
+    checkpoint,
+    out=None,
+    processes=None,
+    progress=True,
+):
+    """
+    Run (name, scenario) pairs, skipping those already in `checkpoint`, and
+    write every trajectory to `out`. Returns the figures of merit of each
+    scenario as a DataFrame indexed by name.
+    """
+    os.makedirs(checkpoint, exist_ok=True)
+    processes = processes or os.cpu_count() or 1
+    status = Progress(len(scenarios)) if progress else None
+
+    summaries, resumed = {}, 0
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {
+            pool.submit(run_scenario, scn, checkpoint): name for name, scn in scenarios
+        }
+        for i, future in enumerate(as_completed(futures), 1):
+            simulated, summaries[futures[future]] = future.result()
+            resumed += not simulated
+            if status is not None:
+                status.update(i, resumed)
+
+    if out is not None:
+        store = ResultCache(checkpoint, max_bytes=0)
+        with ChunkWriter(out) as writer:
+            for name, scn in scenarios:
+                records = store.get(scenario_key(scn))
+                frame = pd.DataFrame(records)
+                frame.insert(0, "scenario", name)
+                writer.write(frame)
+
+    table = pd.DataFrame([summaries[name] for name, _ in scenarios], columns=OUTPUTS)
+    table.index = pd.Index([name for name, _ in scenarios], name="scenario")
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m model", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("manifest", help="scenarios as .yaml, .json or .csv")
+    parser.add_argument(
+        "--out", help=f"trajectories of every scenario, one of {STREAMING}"
+    )
+    parser.add_argument("--summary", help="figures of merit per scenario")
+    parser.add_argument(
+        "--checkpoint",
+        help="directory of finished runs, next to --out (or the manifest) "
+        "by default",
+    )
+    parser.add_argument(
+        "--fresh", action="store_true", help="ignore and replace existing checkpoints"
+    )
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--quiet", action="store_true", help="no progress")
+    args = parser.parse_args(argv)
+
+    if args.out and format_of(args.out) not in STREAMING:
+        parser.error(f"--out must end in one of {STREAMING}")
+
+    scenarios = load_manifest(args.manifest)
+    checkpoint = args.checkpoint or os.path.splitext(args.out or args.manifest)[0] + (
+        ".checkpoint"
+    )
+    if args.fresh:
+        ResultCache(checkpoint).clear(disk=True)
+
+    start = time.perf_counter()
+    table = run_manifest(
+        scenarios,
+        checkpoint,
+        out=args.out,
+        processes=args.processes,
+        progress=not args.quiet,
+    )
+
+    if args.summary:
+        fmt = format_of(args.summary)
+        with open(args.summary, "wb") as f:
+            f.write(to_bytes(table.reset_index(), fmt))
+    else:
+        print(table.to_string(float_format="{:.4g}".format))
+    print(
+        f"{len(table)} scenarios in {time.perf_counter() - start:.2f} s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
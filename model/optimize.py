@@ -0,0 +1,177 @@
+"""
+Feed schedule optimization.
+
+Searches the settings of a control scheme for the largest final titer (or
+peak cell density) with the cross-entropy method: every generation is one
+batch of candidate runs, simulated together through `model.sweep`.
+
+    result = optimize("Bolus Feed", objective="P_final", V_max=1500)
+    result["settings"]  # {"bolus_0": ..., "bolus_1": ..., ...}
+"""
+
+import numpy as np
+import pandas as pd
+
+from model.sweep import run_sweep, OUTPUTS
+
+# Search space of each scheme, (low, high, resolution). The limits follow the
+# sidebar widgets; candidates are rounded to the resolution so that repeated
+# candidates hit the cache and results can be typed back into the sidebar.
+SPACE = {
+    "Bolus Feed": {
+        "bolus_0": (0.0, 1500.0, 10.0),
+        "bolus_1": (0.0, 1500.0, 10.0),
+        "bolus_2": (0.0, 1500.0, 10.0),
+        "bolus_3": (0.0, 1500.0, 10.0),
+    },
+    "Continuous Feed": {
+        "F_Glc": (0.0, 5.0, 0.01),
+        "F_Gln": (0.0, 5.0, 0.01),
+        "t0_glc": (0.0, 250.0, 25.0),
+        "tn_glc": (0.0, 250.0, 25.0),
+        "t0_gln": (0.0, 250.0, 25.0),
+        "tn_gln": (0.0, 250.0, 25.0),
+    },
+    "Bang Control": {
+        "Glc_SP": (0.0, 60.0, 0.5),
+        "Gln_SP": (0.0, 15.0, 0.5),
+        "Glc_DB": (0.0, 15.0, 0.5),
+        "Gln_DB": (0.0, 15.0, 0.5),
+        "F_Glc": (0.0, 2.0, 0.01),
+        "F_Gln": (0.0, 2.0, 0.01),
+    },
+}
+
+# (start, end) pairs that must be ordered
+WINDOWS = [("t0_glc", "tn_glc"), ("t0_gln", "tn_gln")]
+
+OBJECTIVES = ["P_final", "X_max"]
+
+
+def violation(table, V_max=None, alarms=(60.0, 10.0)):
+    """
+    Total relative constraint violation of each run, 0 when feasible
+    """
+    v = np.zeros(len(table))
+    max_Glc, max_Gln = alarms
+    if max_Glc is not None:
+        v += np.maximum(table["Glc_max"].to_numpy() / max_Glc - 1, 0)
+    if max_Gln is not None:
+        v += np.maximum(table["Gln_max"].to_numpy() / max_Gln - 1, 0)
+    if V_max is not None:
+        v += np.maximum(table["V_final"].to_numpy() / V_max - 1, 0)
+    return v
+
+
+def optimize(
+    mode,
+    objective="P_final",
+    initial=None,
+    params=None,
+    fixed=None,
+    space=None,
+    V_max=None,
+    alarms=(60.0, 10.0),
+    population=64,
+    generations=15,
+    elite=0.2,
+    seed=None,
+    t_max=250,
+    dt=1,
+    processes=1,
+    backend=None,
+    cache=None,
+):
+    """
+    Maximize `objective` (a column of OUTPUTS) over the settings of `mode`.
+
+    `initial` (init_sim keyword arguments), `params` and `fixed` settings are
+    held constant. Runs whose Glc/Gln peak exceeds `alarms` or whose final
+    volume exceeds `V_max` always rank below feasible ones.
+
+    Simulated outputs are memoized in `cache`; pass the same dict to later
+    calls to reuse them.
+
+    Returns a dict with the best settings, its score and outputs, and the
+    number of simulations and cache hits.
+    """
+    if objective not in OUTPUTS:
+        raise ValueError(f"Unknown objective {objective!r}, expected one of {OUTPUTS}")
+
+    space = space or SPACE[mode]
+    keys = list(space)
+    low, high, res = (np.array([space[k][i] for k in keys]) for i in range(3))
+
+    constants = dict(fixed or {})
+    constants.update(initial or {})
+    constants.update(params or {})
+
+    rng = np.random.default_rng(seed)
+    cache = {} if cache is None else cache
+    context = (mode, t_max, dt, tuple(sorted(constants.items())))
+    stats = {"evaluations": 0, "cache_hits": 0}
+
+    def snap(x):
+        x = np.clip(np.round(x / res) * res, low, high).round(6)
+        for start, end in WINDOWS:
+            if start in keys and end in keys:
+                i, j = keys.index(start), keys.index(end)
+                x[:, [i, j]] = np.sort(x[:, [i, j]], axis=1)
+        return x
+
+    def evaluate(x):
+        rows = [(context, tuple(r)) for r in x]
+        todo = list(dict.fromkeys(r for r in rows if r not in cache))
+        stats["cache_hits"] += len(rows) - len(todo)
+
+        if todo:
+            design = dict(zip(keys, np.array([r for _, r in todo]).T))
+            table = run_sweep(
+                design,
+                mode=mode,
+                fixed=constants,
+                t_max=t_max,
+                dt=dt,
+                processes=processes,
+                backend=backend,
+            )
+            for r, out in zip(todo, table[OUTPUTS].to_dict("records")):
+                cache[r] = out
+            stats["evaluations"] += len(todo)
+
+        table = pd.DataFrame([cache[r] for r in rows])
+        v = violation(table, V_max, alarms)
+        # objectives are non-negative, so infeasible runs rank below all
+        # feasible ones and among themselves by how far off they are
+        return np.where(v > 0, -v, table[objective].to_numpy())
+
+    mean = (low + high) / 2
+    std = (high - low) / 2
+    n_elite = max(int(elite * population), 2)
+    history = []
+
+    best, score = None, -np.inf
+
+    for _ in range(generations):
+        x = snap(mean + std * rng.standard_normal((population, len(keys))))
+        scores = evaluate(x)
+
+        elites = np.argsort(scores)[::-1][:n_elite]
+        mean = 0.7 * x[elites].mean(axis=0) + 0.3 * mean
+        std = 0.7 * x[elites].std(axis=0) + 0.3 * std
+        history.append(float(scores[elites[0]]))
+
+        if scores[elites[0]] > score:
+            best, score = x[elites[0]], scores[elites[0]]
+
+        if np.all(std < res):
+            break
+
+    return {
+        "settings": dict(zip(keys, map(float, best))),
+        "score": float(score),
+        "feasible": bool(score >= 0),
+        "outputs": cache[(context, tuple(best))],
+        "history": history,
+        **stats,
+    }
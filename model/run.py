@@ -1,3 +1,9 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+
+
 def mu_func(res, param):
     """
     Cell growth function
@@ -77,6 +83,19 @@ def PPR(res, param):
     return q_P
 
 
+# Part of every scenario key (see `model.scenario`). Bump it whenever a change
+# to the rate laws, the integrators or the controllers changes trajectories,
+# so results cached on disk by an earlier version are not served again.
+MODEL_VERSION = 2
+
+STATE = ["X", "Glc", "Gln", "Lac", "Amm", "P", "V"]
+FEEDS = ["F_Glc", "F_Gln", "F_B"]
+RATES = ["mu", "kD", "q_Glc", "q_Gln", "q_Lac", "q_Amm", "q_P"]
+COLUMNS = STATE + ["t"] + FEEDS + RATES
+
+# keyword arguments of init_sim
+INITIAL = ["X_0", "Glc_0", "Gln_0", "Lac_0", "Amm_0", "P_0", "V_0"]
+
 param = {
     "mu_max": 0.045,  # 1/h,
     "Ks_Glc": 2.5,  # mM,
@@ -96,6 +115,80 @@ param = {
     "Kl3_Amm": 5,
 }
 
+# Immutable, positional parameter set. Resolve once with `resolve` and pass it
+# around instead of the dict; np.asarray(p) gives the parameter vector.
+Params = namedtuple("Params", list(param))
+
+
+def resolve(params=None):
+    """
+    Turn a parameter dict (or pandas Series) into a Params tuple. Missing keys
+    fall back to the defaults in `param`.
+    """
+    if isinstance(params, Params):
+        return params
+    if params is None:
+        params = param
+    return Params(*(float(params.get(k, v)) for k, v in param.items()))
+
+
+def kinetics(X, Glc, Gln, Lac, Amm, p):
+    """
+    All rate laws in a single pass.
+
+    Returns (mu, kD, q_Glc, q_Gln, q_Lac, q_Amm, q_P), the same values as
+    mu_func, k_D, GUR, GlnUR, LPR, APR and PPR.
+    """
+    (
+        mu_max,
+        Ks_Glc,
+        Ks_Gln,
+        Yx_Glc,
+        m_Glc,
+        qmax_Gln,
+        Kq_Gln,
+        Ylac_Glc,
+        Yamm_Gln,
+        alpha,
+        beta,
+        Kl1_Lac,
+        Kl2_Lac,
+        Kl1_Amm,
+        Kl2_Amm,
+        Kl3_Amm,
+    ) = p
+
+    mu = (
+        (mu_max * Glc / (Ks_Glc + Glc))
+        * ((0.5 * Ks_Gln + Gln) / (Ks_Gln + Gln))
+        * (Kl1_Amm / (Kl1_Amm + Amm))
+        * (Kl1_Lac / (Kl1_Lac + Lac))
+    )
+
+    if Glc > 0:
+        kD = 0.05 * (1 - Kl2_Amm / (Kl2_Amm + Amm)) + 0.05 * (
+            1 - Kl2_Lac / (Kl2_Lac + Lac)
+        )
+        q_Glc = mu / Yx_Glc + m_Glc
+    else:
+        kD = 0.1
+        q_Glc = 0
+
+    q_Gln = 0
+    if Gln > 0:
+        q_Gln = qmax_Gln * Gln / (Kq_Gln + Gln)
+
+    if Gln > 0.5:
+        q_Lac = Ylac_Glc * q_Glc
+        q_Amm = Yamm_Gln * q_Gln
+    else:
+        q_Lac = 0
+        q_Amm = 1e-8
+
+    q_P = (alpha * mu + beta) * Kl3_Amm / (Kl3_Amm + Amm)
+
+    return mu, kD, q_Glc, q_Gln, q_Lac, q_Amm, q_P
+
 
 def init_sim(
     X_0=2.0e5,  # Cells/mL
@@ -122,22 +215,17 @@ def init_sim(
     res["F_Gln"] = 0
     res["F_B"] = 0
 
-    res["mu"] = mu_func(res, param)
-    res["kD"] = k_D(res, param)
-    res["q_Glc"] = GUR(res, param)
-    res["q_Gln"] = GlnUR(res, param)
-    res["q_Lac"] = LPR(res, param)
-    res["q_Amm"] = APR(res, param)
-    res["q_P"] = PPR(res, param)
+    p = resolve(params)
+    res.update(zip(RATES, kinetics(X_0, Glc_0, Gln_0, Lac_0, Amm_0, p)))
 
     return res
 
 
-def gen(data, Glc_F, Gln_F, F_Glc, F_Gln, F_B, t_max=250, dt=1):
-    res = data.to_dict()
-
-    if res["t"] >= t_max:
-        return
+def step(res, Glc_F, Gln_F, F_Glc, F_Gln, F_B, dt=1, params=param):
+    """
+    Advance a state dict by one explicit Euler step and return the new state
+    """
+    res = dict(res)
 
     t = res["t"] + dt
 
@@ -186,12 +274,100 @@ def gen(data, Glc_F, Gln_F, F_Glc, F_Gln, F_B, t_max=250, dt=1):
     res["F_B"] = F_B
 
     # kinetics
-    res["mu"] = mu_func(res, param)
-    res["kD"] = k_D(res, param)
-    res["q_Glc"] = GUR(res, param)
-    res["q_Gln"] = GlnUR(res, param)
-    res["q_Lac"] = LPR(res, param)
-    res["q_Amm"] = APR(res, param)
-    res["q_P"] = PPR(res, param)
-
-    yield res
+    res.update(zip(RATES, kinetics(X, Glc, Gln, Lac, Amm, resolve(params))))
+
+    return res
+
+
+def gen(data, Glc_F, Gln_F, F_Glc, F_Gln, F_B, t_max=250, dt=1, params=param):
+    res = dict(data)
+
+    if res["t"] >= t_max:
+        return
+
+    yield step(res, Glc_F, Gln_F, F_Glc, F_Gln, F_B, dt=dt, params=params)
+
+
+# Default feed concentrations used by the app
+GLC_F = 2500.0  # mM
+GLN_F = 100.0  # mM
+
+
+def no_control(t, res, dt):
+    """
+    Batch operation: no feeds at all
+    """
+    return GLC_F, GLN_F, 0.0, 0.0, 0.0
+
+
+# the feeds do not depend on the state, so they can be tabulated ahead
+no_control.open_loop = True
+
+
+def n_steps(t_max, dt, t_0=0.0):
+    """
+    Number of steps `gen` takes to go from t_0 to t_max
+    """
+    return max(math.ceil((t_max - t_0) / dt - 1e-9), 0)
+
+
+def simulate(
+    initial=None,
+    params=param,
+    controller=no_control,
+    t_max=250,
+    dt=1,
+    method="euler",
+    backend=None,
+    **options,
+):
+    """
+    Run a whole trajectory headlessly.
+
+    `initial` is either a dict of `init_sim` keyword arguments or a full state
+    row (with "t", e.g. a record returned by `simulate`) to continue from.
+    `controller(t, res, dt)` returns (Glc_F, Gln_F, F_Glc, F_Gln, F_B) for the
+    next step.
+
+    Returns a structured array with one record per time point and the fields
+    in COLUMNS, so `pd.DataFrame(simulate())` matches the app's data frame.
+
+    `method` selects the integrator: "euler" (the fixed step scheme used by
+    `gen`) or an adaptive one from `model.integrate` such as "RK45" or "BDF",
+    which take extra `options` like rtol, atol and breakpoints.
+
+    `backend` picks the implementation of the Euler loop, see `model.backend`.
+    """
+    if method != "euler":
+        from model.integrate import integrate
+
+        return integrate(initial, params, controller, t_max, dt, method, **options)
+
+    params = resolve(params)
+
+    if initial is None:
+        initial = {}
+    elif isinstance(initial, np.void):
+        initial = dict(zip(initial.dtype.names, initial.tolist()))
+
+    if "t" in initial:
+        res = {k: float(initial[k]) for k in COLUMNS}
+    else:
+        res = init_sim(**initial, params=params)
+
+    from model.backend import get_backend
+
+    if get_backend(backend) == "numba":
+        from model.backend import simulate as compiled
+
+        return compiled(res, params, controller, t_max, dt)
+
+    n = n_steps(t_max, dt, res["t"])
+    buf = np.empty((n + 1, len(COLUMNS)))
+    buf[0] = [res[k] for k in COLUMNS]
+
+    for i in range(1, n + 1):
+        res = step(res, *controller(res["t"], res, dt), dt=dt, params=params)
+        buf[i] = [res[k] for k in COLUMNS]
+
+    return buf.view([(k, "float64") for k in COLUMNS]).reshape(-1)
@@ -0,0 +1,152 @@
+"""
+Scenario description and hashing.
+
+A scenario holds everything that determines a trajectory: the initial
+conditions, the kinetic constants, the step time, the horizon and the control
+schedule. The schedule is a list of (t, mode, settings) entries, each applying
+from time t on, so a run whose controls were changed halfway is described as
+exactly as one that was left alone. An entry may end with its own step time,
+(t, mode, settings, dt), for runs whose step time changed halfway; without
+one the scenario's dt applies.
+
+    key = scenario_key(scenario(initial, params, [(0.0, "Bolus Feed", {...})]))
+"""
+
+import hashlib
+import json
+
+import numpy as np
+
+from model.run import MODEL_VERSION, resolve, simulate
+from model.control import make_controller
+
+
+def _canonical(value):
+    """
+    Plain JSON types with every number as a float, so 1, 1.0 and
+    np.float64(1) hash the same
+    """
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if hasattr(value, "_asdict"):
+        return _canonical(value._asdict())
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    return value
+
+
+def scenario(initial, params=None, schedule=(), dt=1, t_max=250):
+    """
+    Canonical scenario dict. `initial` is a dict of init_sim keyword
+    arguments, `params` anything `resolve` accepts. The schedule must start at
+    t=0 and be in time order.
+    """
+    times = [float(entry[0]) for entry in schedule]
+    if times and times[0] != 0:
+        raise ValueError(f"The control schedule starts at t={times[0]}, not 0")
+    if any(b < a for a, b in zip(times, times[1:])):
+        raise ValueError(f"The control schedule times {times} are out of order")
+    if any(len(entry) > 3 and not float(entry[3]) > 0 for entry in schedule):
+        raise ValueError("The step times of the control schedule must be positive")
+    return _canonical(
+        {
+            "initial": dict(initial),
+            "params": resolve(params),
+            "schedule": [list(entry) for entry in schedule],
+            "dt": dt,
+            "t_max": t_max,
+        }
+    )
+
+
+def scenario_key(scenario):
+    """
+    Stable hex digest of a scenario dict, salted with the model version
+    """
+    text = json.dumps(
+        _canonical({"model": MODEL_VERSION, **scenario}),
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _resume_row(records, t):
+    """
+    Number of records up to and including time t
+    """
+    return int(np.searchsorted(records["t"], t + 1e-9 * max(abs(t), 1.0)))
+
+
+def reproducible(scenario):
+    """
+    Whether the trajectory of a scenario follows from it alone. An MPC with a
+    time `budget` stops refining on the wall clock, so a live run with one
+    depends on the load of the machine.
+    """
+    return not any(
+        entry[1] == "MPC" and entry[2].get("budget") is not None
+        for entry in scenario["schedule"]
+    )
+
+
+def _replay_settings(mode, settings):
+    """
+    Settings to simulate a schedule entry with, the MPC always doing its full
+    rounds
+    """
+    if mode == "MPC":
+        return {k: v for k, v in settings.items() if k != "budget"}
+    return settings
+
+
+def simulate_scenario(scenario, cache=None):
+    """
+    Euler trajectory of a scenario dict.
+
+    With a `model.cache.ResultCache`, a repeated scenario is loaded from the
+    cache, and one that shares its first schedule entries with a cached
+    scenario resumes from the cached state at the time the controls changed.
+    Every schedule prefix simulated on the way is cached too. An MPC `budget`
+    is ignored, so the same scenario always gives the same trajectory.
+    """
+    schedule = scenario["schedule"] or [[0.0, "Continuous Feed", {}]]
+    keys = [
+        scenario_key(dict(scenario, schedule=schedule[: k + 1]))
+        for k in range(len(schedule))
+    ]
+
+    records, done = None, 0
+    if cache is not None:
+        for k in range(len(schedule), 0, -1):
+            records = cache.get(keys[k - 1])
+            if records is not None:
+                done = k
+                break
+
+    for k in range(done, len(schedule)):
+        t, mode, settings = schedule[k][:3]
+        dt = schedule[k][3] if len(schedule[k]) > 3 else scenario["dt"]
+        if records is None:
+            start, head = scenario["initial"], records
+        else:
+            i = _resume_row(records, t)
+            start, head = records[i - 1], records[: i - 1]
+        tail = simulate(
+            start,
+            scenario["params"],
+            make_controller(
+                mode, params=scenario["params"], **_replay_settings(mode, settings)
+            ),
+            t_max=scenario["t_max"],
+            dt=dt,
+        )
+        records = tail if head is None else np.concatenate([head, tail])
+        if cache is not None:
+            cache.put(keys[k], records)
+
+    return records
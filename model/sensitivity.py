@@ -0,0 +1,383 @@
+"""
+Global sensitivity analysis of the kinetic constants and initial conditions.
+
+Each factor (a `param` name or an `init_sim` keyword argument) varies
+uniformly over a range: the constants by `spread` around their default, the
+initial conditions over the range of the sidebar inputs. Samples come from a
+scrambled Sobol sequence and are run as a sweep, in vectorized batches spread
+over a process pool, see `model.sweep`.
+
+    result = sobol(1024, ["mu_max", "Ks_Glc", "Yx_Glc", "Glc_0", "Gln_0"])
+    result["indices"]["P_final"]    # S1, S1_conf, ST, ST_conf per factor
+
+    result = morris(20)             # every factor, 20 trajectories
+    result["indices"]["X_max"]      # mu, mu_star, sigma per factor
+
+`sobol` takes n * (k + 2) runs for k factors (Saltelli's design) and
+estimates the first order and total indices with bootstrap confidence
+intervals. `morris` takes r * (k + 1) runs and gives the elementary effects,
+a cheaper screening to pick the factors worth a Sobol study.
+
+From the shell:
+
+    python -m model.sensitivity --method sobol --samples 1024 \\
+        --factors mu_max,Ks_Glc,Glc_0 --set F_Glc=0.5 --out indices.csv
+"""
+
+import argparse
+import math
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from model.run import param, INITIAL
+from model.control import MODES
+from model.sweep import run_sweep
+
+# initial conditions over the range of the sidebar inputs
+INITIAL_RANGES = {
+    "X_0": (1.0e5, 1.0e6),
+    "Glc_0": (0.0, 60.0),
+    "Gln_0": (0.0, 10.0),
+    "Lac_0": (0.0, 60.0),
+    "Amm_0": (0.0, 100.0),
+    "P_0": (0.0, 400.0),
+    "V_0": (100.0, 10000.0),
+}
+
+# constants whose default is 0, so a relative spread does not apply
+ZERO_RANGES = {"alpha": (0.0, 1.0e-4)}
+
+FACTORS = list(param) + INITIAL
+
+OUTPUTS = ["P_final", "X_max", "Lac_final", "Amm_final"]
+
+
+def factor_ranges(factors=None, spread=0.5, ranges=None):
+    """
+    (low, high) of each factor. Constants vary by +/- `spread` of their
+    default, `ranges` overrides any factor.
+    """
+    factors = list(FACTORS if factors is None else factors)
+    ranges = ranges or {}
+    out = {}
+    for k in factors:
+        if k in ranges:
+            out[k] = tuple(map(float, ranges[k]))
+        elif k in INITIAL:
+            out[k] = INITIAL_RANGES[k]
+        elif k in param:
+            v = float(param[k])
+            out[k] = (
+                ZERO_RANGES.get(k) if v == 0 else (v * (1 - spread), v * (1 + spread))
+            )
+        else:
+            raise ValueError(f"Unknown factor {k!r}, expected one of {FACTORS}")
+        if out[k] is None or not out[k][0] < out[k][1]:
+            raise ValueError(f"Empty range {out[k]} for {k!r}")
+    return out
+
+
+def _scale(unit, ranges):
+    """
+    Map samples of the unit hypercube to a design over `ranges`
+    """
+    low, high = np.array(list(ranges.values())).T
+    values = low + unit * (high - low)
+    return {k: values[:, j] for j, k in enumerate(ranges)}
+
+
+def _evaluate(unit, ranges, outputs, **options):
+    table = run_sweep(_scale(unit, ranges), **options)
+    return table[outputs].to_numpy(dtype="float64")
+
+
+def sobol(
+    n=1024,
+    factors=None,
+    outputs=OUTPUTS,
+    spread=0.5,
+    ranges=None,
+    mode="Continuous Feed",
+    fixed=None,
+    resamples=100,
+    level=0.95,
+    seed=None,
+    t_max=250,
+    dt=1,
+    processes=None,
+    chunksize=None,
+    backend=None,
+):
+    """
+    First order (S1) and total (ST) Sobol indices of each factor on each
+    output, from n base samples rounded up to a power of two.
+
+    Returns a dict with one DataFrame of indices and their confidence
+    half-widths at `level` per output, the factor ranges and timings.
+    The remaining arguments are those of `model.sweep.run_sweep`.
+    """
+    from scipy.stats import qmc
+
+    start = time.perf_counter()
+    ranges = factor_ranges(factors, spread, ranges)
+    k = len(ranges)
+    n = 2 ** math.ceil(math.log2(max(n, 2)))
+
+    # Saltelli: matrices A and B, and A with column i taken from B
+    AB = qmc.Sobol(2 * k, seed=seed).random(n)
+    A, B = AB[:, :k], AB[:, k:]
+    mixed = np.repeat(A[None], k, axis=0)
+    for i in range(k):
+        mixed[i, :, i] = B[:, i]
+    unit = np.concatenate([A, B, mixed.reshape(k * n, k)])
+    sampled = time.perf_counter()
+
+    y = _evaluate(
+        unit,
+        ranges,
+        list(outputs),
+        mode=mode,
+        fixed=fixed,
+        t_max=t_max,
+        dt=dt,
+        processes=processes,
+        chunksize=chunksize,
+        backend=backend,
+    )
+    simulated = time.perf_counter()
+
+    fA, fB, fAB = y[:n], y[n : 2 * n], y[2 * n :].reshape(k, n, -1)
+
+    def indices(i):
+        # i indexes the base samples, (resamples x n) for the bootstrap
+        a, b, ab = fA[i], fB[i], fAB[:, i]
+        var = np.concatenate([a, b], axis=-2).var(axis=-2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            # Saltelli et al. (2010) for S1, Jansen for ST
+            S1 = (b * (ab - a)).mean(axis=-2) / var
+            ST = 0.5 * ((a - ab) ** 2).mean(axis=-2) / var
+        return S1, ST
+
+    S1, ST = indices(np.arange(n))
+    rng = np.random.default_rng(seed)
+    boot = rng.integers(n, size=(resamples, n))
+    S1_boot, ST_boot = indices(boot)
+    z = _z(level)
+    S1_conf = z * np.nanstd(S1_boot, axis=1)
+    ST_conf = z * np.nanstd(ST_boot, axis=1)
+
+    names = list(ranges)
+    table = {
+        out: pd.DataFrame(
+            {
+                "S1": S1[:, j],
+                "S1_conf": S1_conf[:, j],
+                "ST": ST[:, j],
+                "ST_conf": ST_conf[:, j],
+            },
+            index=pd.Index(names, name="factor"),
+        )
+        for j, out in enumerate(outputs)
+    }
+    return {
+        "method": "sobol",
+        "indices": table,
+        "ranges": ranges,
+        "samples": n,
+        "level": level,
+        "timing": _timing(start, sampled, simulated, len(unit)),
+    }
+
+
+def morris(
+    r=20,
+    factors=None,
+    outputs=OUTPUTS,
+    levels=4,
+    spread=0.5,
+    ranges=None,
+    mode="Continuous Feed",
+    fixed=None,
+    seed=None,
+    t_max=250,
+    dt=1,
+    processes=None,
+    chunksize=None,
+    backend=None,
+):
+    """
+    Morris elementary effects of each factor on each output from r
+    trajectories on a grid of `levels` levels.
+
+    Returns a dict with one DataFrame per output giving the mean effect
+    (mu), the mean absolute effect (mu_star) and its spread (sigma), scaled
+    to the whole range of the factor, plus the factor ranges and timings.
+    """
+    start = time.perf_counter()
+    ranges = factor_ranges(factors, spread, ranges)
+    k = len(ranges)
+    rng = np.random.default_rng(seed)
+    delta = levels / (2 * (levels - 1))
+
+    # each trajectory moves one factor at a time by delta, in random order,
+    # starting from a grid point low enough to take the step
+    base = rng.integers(levels // 2, size=(r, 1, k)) / (levels - 1)
+    order = np.argsort(rng.random((r, k)), axis=1)
+    steps = np.zeros((r, k + 1, k))
+    for i in range(k):
+        steps[np.arange(r), i + 1 :, order[:, i]] = delta
+    unit = base + steps
+    # half of the factors step down instead, from the mirrored point
+    down = rng.random((r, 1, k)) < 0.5
+    unit = np.where(down, 1 - unit, unit)
+    sampled = time.perf_counter()
+
+    y = _evaluate(
+        unit.reshape(-1, k),
+        ranges,
+        list(outputs),
+        mode=mode,
+        fixed=fixed,
+        t_max=t_max,
+        dt=dt,
+        processes=processes,
+        chunksize=chunksize,
+        backend=backend,
+    )
+    simulated = time.perf_counter()
+
+    y = y.reshape(r, k + 1, -1)
+    sign = np.where(down[:, 0], -1.0, 1.0)
+    effects = np.empty((r, k, y.shape[-1]))
+    for i in range(k):
+        j = order[:, i]
+        effects[np.arange(r), j] = (
+            (y[:, i + 1] - y[:, i]) * sign[np.arange(r), j][:, None] / delta
+        )
+
+    names = list(ranges)
+    table = {
+        out: pd.DataFrame(
+            {
+                "mu": effects[:, :, j].mean(axis=0),
+                "mu_star": np.abs(effects[:, :, j]).mean(axis=0),
+                "sigma": effects[:, :, j].std(axis=0, ddof=1) if r > 1 else np.nan,
+            },
+            index=pd.Index(names, name="factor"),
+        )
+        for j, out in enumerate(outputs)
+    }
+    return {
+        "method": "morris",
+        "indices": table,
+        "ranges": ranges,
+        "trajectories": r,
+        "timing": _timing(start, sampled, simulated, unit.shape[0] * unit.shape[1]),
+    }
+
+
+def _z(level):
+    from scipy.stats import norm
+
+    return float(norm.ppf((1 + level) / 2))
+
+
+def _timing(start, sampled, simulated, runs):
+    end = time.perf_counter()
+    return {
+        "runs": runs,
+        "sampling": sampled - start,
+        "simulation": simulated - sampled,
+        "analysis": end - simulated,
+        "total": end - start,
+        "runs_per_second": runs / max(simulated - sampled, 1e-9),
+    }
+
+
+def to_frame(result):
+    """
+    All indices of a result in one long table, one row per output and factor
+    """
+    return pd.concat(result["indices"], names=["output"]).reset_index()
+
+
+def _pairs(items):
+    return [item.split("=", 1) for item in items or []]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m model.sensitivity", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--method", default="sobol", choices=["sobol", "morris"])
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=None,
+        help="Sobol base samples (1024) or Morris trajectories (20)",
+    )
+    parser.add_argument(
+        "--factors", default=None, help="comma separated factors, all by default"
+    )
+    parser.add_argument("--outputs", default=",".join(OUTPUTS))
+    parser.add_argument(
+        "--spread", type=float, default=0.5, help="relative range of the constants"
+    )
+    parser.add_argument(
+        "--range", action="append", metavar="KEY=LOW:HIGH", help="factor range"
+    )
+    parser.add_argument("--mode", default="Continuous Feed", choices=MODES)
+    parser.add_argument(
+        "--set", action="append", metavar="KEY=VALUE", help="fixed setting"
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--t-max", type=float, default=250)
+    parser.add_argument("--dt", type=float, default=1)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--backend", default=None)
+    parser.add_argument("--out", help="write the indices to a .csv file")
+    args = parser.parse_args(argv)
+
+    options = dict(
+        factors=args.factors and [k.strip() for k in args.factors.split(",")],
+        outputs=[k.strip() for k in args.outputs.split(",")],
+        spread=args.spread,
+        ranges={k: v.split(":") for k, v in _pairs(args.range)},
+        mode=args.mode,
+        fixed={k: float(v) for k, v in _pairs(args.set)},
+        seed=args.seed,
+        t_max=args.t_max,
+        dt=args.dt,
+        processes=args.processes,
+        backend=args.backend,
+    )
+    if args.method == "sobol":
+        result = sobol(args.samples or 1024, **options)
+    else:
+        result = morris(args.samples or 20, **options)
+
+    for out, table in result["indices"].items():
+        key = "ST" if args.method == "sobol" else "mu_star"
+        print(f"\n{out}")
+        print(
+            table.sort_values(key, ascending=False).to_string(
+                float_format="{:.4g}".format
+            )
+        )
+    if args.out:
+        to_frame(result).to_csv(args.out, index=False)
+
+    timing = result["timing"]
+    print(
+        "{runs} runs in {total:.2f} s: sampling {sampling:.3f} s, simulation "
+        "{simulation:.2f} s ({runs_per_second:.0f} runs/s), analysis "
+        "{analysis:.3f} s".format(**timing),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
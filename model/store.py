@@ -0,0 +1,262 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from model.run import COLUMNS
+
+
+class Trajectory:
+    """
+    Growable columnar store for one simulation run.
+
+    Rows are appended in amortized O(1) into a preallocated buffer that
+    doubles when full. Each column is contiguous, so `traj["X"]` is a
+    zero-copy view of the history.
+    """
+
+    def __init__(self, columns=COLUMNS, capacity=256, dtype="float64"):
+        self.columns = list(columns)
+        self._index = {k: j for j, k in enumerate(self.columns)}
+        self._buf = np.empty((len(self.columns), capacity), dtype=dtype)
+        self._n = 0
+        # bumped on every change, lets callers cache derived data
+        self.version = 0
+
+    @classmethod
+    def from_records(cls, records, columns=None, dtype="float64"):
+        """
+        Build from a structured array such as the output of `simulate`
+        """
+        columns = columns or list(records.dtype.names)
+        traj = cls(columns, capacity=max(len(records), 1), dtype=dtype)
+        traj.extend(records)
+        return traj
+
+    @classmethod
+    def load(cls, file):
+        """
+        Read a trajectory written by `save`
+        """
+        with np.load(file, allow_pickle=False) as f:
+            columns, data = f["columns"].tolist(), f["data"]
+        traj = cls(columns, capacity=max(data.shape[1], 1), dtype=data.dtype)
+        traj._buf[:, : data.shape[1]] = data
+        traj._n = data.shape[1]
+        return traj
+
+    def save(self, file):
+        """
+        Write the rows in use to an .npz file
+        """
+        np.savez(file, columns=np.array(self.columns), data=self._buf[:, : self._n])
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, name):
+        return self._buf[self._index[name], : self._n]
+
+    @property
+    def capacity(self):
+        return self._buf.shape[1]
+
+    @property
+    def nbytes(self):
+        return self._buf.nbytes
+
+    def _reserve(self, n):
+        if n <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < n:
+            capacity *= 2
+        buf = np.empty((len(self.columns), capacity), dtype=self._buf.dtype)
+        buf[:, : self._n] = self._buf[:, : self._n]
+        self._buf = buf
+
+    def append(self, res):
+        """
+        Append one row given as a dict (or Series) with every column
+        """
+        self._reserve(self._n + 1)
+        self._buf[:, self._n] = [res[k] for k in self.columns]
+        self._n += 1
+        self.version += 1
+
+    def extend(self, records):
+        """
+        Append many rows from a structured array or a dict of columns
+        """
+        n = len(records[self.columns[0]])
+        self._reserve(self._n + n)
+        for j, k in enumerate(self.columns):
+            self._buf[j, self._n : self._n + n] = records[k]
+        self._n += n
+        self.version += 1
+
+    def row(self, i=-1):
+        """
+        Row i as a dict of floats
+        """
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError("row index out of range")
+        return dict(zip(self.columns, self._buf[:, i].tolist()))
+
+    def last(self):
+        return self.row(-1)
+
+    def compact(self, dtype=None):
+        """
+        Copy trimmed to the rows in use, optionally cast (e.g. to float32)
+        """
+        traj = Trajectory(
+            self.columns, capacity=max(self._n, 1), dtype=dtype or self._buf.dtype
+        )
+        traj._buf[:, : self._n] = self._buf[:, : self._n]
+        traj._n = self._n
+        return traj
+
+    def truncate(self, n):
+        """
+        Drop every row after the first n
+        """
+        self._n = min(n, self._n)
+        self.version += 1
+
+    def to_frame(self, columns=None, start=0):
+        """
+        DataFrame of the selected columns from row `start` on, indexed by t
+        """
+        columns = columns or self.columns
+        frame = pd.DataFrame({k: self[k][start:] for k in columns}, copy=False)
+        if "t" in self._index:
+            frame.index = pd.Index(self["t"][start:], name="t")
+        return frame
+
+
+class RunRegistry:
+    """
+    Completed runs keyed by scenario hash.
+
+    Runs are kept compacted to `dtype`; once they take more than `budget`
+    bytes, or there are more than `max_runs` of them, the least recently used
+    ones are dropped. The latest run is always kept. `spill` moves the runs
+    to disk, e.g. while their session is idle, and `get` loads them back.
+    """
+
+    def __init__(self, budget=32 * 2**20, dtype="float32", max_runs=None):
+        self.budget = budget
+        self.dtype = dtype
+        self.max_runs = max_runs
+        # label and Trajectory, or the file of a spilled run
+        self._runs = OrderedDict()
+        self._added = {}
+        self._count = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._runs)
+
+    def __contains__(self, key):
+        return key in self._runs
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of the runs held in memory
+        """
+        return sum(
+            traj.nbytes
+            for _, traj in list(self._runs.values())
+            if isinstance(traj, Trajectory)
+        )
+
+    @property
+    def spilled(self):
+        return sum(not isinstance(traj, Trajectory) for _, traj in self._runs.values())
+
+    def _full(self):
+        if self.max_runs is not None and len(self._runs) > self.max_runs:
+            return True
+        return self.nbytes > self.budget
+
+    def add(self, key, traj, label=None):
+        with self._lock:
+            order = self._added.get(key, self._count)
+            self.remove(key)
+            self._runs[key] = (label or key[:8], traj.compact(self.dtype))
+            self._added[key] = order
+            self._count = max(self._count, order + 1)
+            self._evict({key})
+
+    def _evict(self, keep=()):
+        """
+        Drop the least recently used runs, other than those in `keep`, until
+        the limits are met
+        """
+        for key in list(self._runs):
+            if not self._full():
+                break
+            if key not in keep:
+                self.remove(key)
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        """
+        Runs of `keys`, loading spilled ones back. The limits are applied
+        once all of them are in memory, so none of them is dropped on the way.
+        """
+        with self._lock:
+            runs = []
+            for key in keys:
+                self._runs.move_to_end(key)
+                label, traj = self._runs[key]
+                if not isinstance(traj, Trajectory):
+                    file, traj = traj, Trajectory.load(traj)
+                    os.remove(file)
+                    self._runs[key] = (label, traj)
+                runs.append(traj)
+            self._evict(set(keys))
+            return runs
+
+    def label(self, key):
+        return self._runs[key][0]
+
+    def keys(self):
+        """
+        Keys in the order the runs were added
+        """
+        return sorted(self._runs, key=self._added.get)
+
+    def remove(self, key):
+        with self._lock:
+            _, traj = self._runs.pop(key, (None, None))
+            self._added.pop(key, None)
+            if isinstance(traj, str) and os.path.exists(traj):
+                os.remove(traj)
+
+    def spill(self, path):
+        """
+        Write the runs held in memory to .npz files in `path` and drop them
+        from memory. Returns the number of bytes freed.
+        """
+        with self._lock:
+            freed = 0
+            for key, (label, traj) in list(self._runs.items()):
+                if isinstance(traj, Trajectory):
+                    os.makedirs(path, exist_ok=True)
+                    file = os.path.join(path, key + ".npz")
+                    traj.save(file)
+                    self._runs[key] = (label, file)
+                    freed += traj.nbytes
+            return freed
@@ -0,0 +1,302 @@
+"""
+Parameter sweeps and Monte Carlo studies on top of the batch engine.
+
+A design is a dict of equal length columns keyed by `param` names, `init_sim`
+keyword arguments (X_0, Glc_0, ...) or settings of the chosen control scheme
+(F_Glc, t0_glc, Glc_SP, bolus_0, ...). Each row is one run.
+
+    design = cross(grid(mu_max=[0.03, 0.045, 0.06]), sample(200, Ks_Glc=(1, 4)))
+    table = run_sweep(design, mode="Continuous Feed", fixed={"F_Glc": 0.5})
+
+`iter_sweep` yields the table chunk by chunk instead, e.g. to stream a large
+study to disk with `model.export.ChunkWriter`.
+
+From the shell:
+
+    python -m model.sweep --grid mu_max=0.03:0.06:4 --sample Ks_Glc=1:4 \\
+        --samples 500 --set F_Glc=0.5 --processes 4 --out sweep.csv
+"""
+
+import argparse
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from model.run import param, INITIAL
+from model.batch import init_batch, param_array, run_batch
+from model.control import make_controller, MODES
+from model.export import ChunkWriter, format_of, STREAMING
+
+OUTPUTS = [
+    "P_final",
+    "X_max",
+    "t_X_max",
+    "Glc_max",
+    "Gln_max",
+    "Lac_final",
+    "Amm_final",
+    "V_final",
+]
+
+
+def grid(**axes):
+    """
+    Full factorial design over the given values of each key
+    """
+    mesh = np.meshgrid(
+        *[np.asarray(v, dtype="float64") for v in axes.values()], indexing="ij"
+    )
+    return {k: m.ravel() for k, m in zip(axes, mesh)}
+
+
+def sample(n, seed=None, **distributions):
+    """
+    Monte Carlo design with n rows.
+
+    A distribution is a (low, high) tuple for a uniform draw, a list of
+    values to pick from, or a callable taking (rng, n).
+    """
+    rng = np.random.default_rng(seed)
+    design = {}
+    for k, dist in distributions.items():
+        if callable(dist):
+            design[k] = np.asarray(dist(rng, n), dtype="float64")
+        elif isinstance(dist, tuple):
+            design[k] = rng.uniform(dist[0], dist[1], n)
+        else:
+            design[k] = rng.choice(np.asarray(dist, dtype="float64"), n)
+    return design
+
+
+def cross(*designs):
+    """
+    Every row of each design combined with every row of the others
+    """
+    out = {}
+    size = 1
+    for design in designs:
+        n = len(next(iter(design.values()))) if design else 1
+        out = {k: np.repeat(v, n) for k, v in out.items()}
+        out.update({k: np.tile(np.asarray(v), size) for k, v in design.items()})
+        size *= n
+    return out
+
+
+def summarize(t, out):
+    """
+    Figures of merit for each run of a recorded `run_batch` trajectory
+    """
+    X = out[:, :, 0]
+    i_max = X.argmax(axis=0)
+    return {
+        "P_final": out[-1, :, 5],
+        "X_max": X.max(axis=0),
+        "t_X_max": t[i_max],
+        "Glc_max": out[:, :, 1].max(axis=0),
+        "Gln_max": out[:, :, 2].max(axis=0),
+        "Lac_final": out[-1, :, 3],
+        "Amm_final": out[-1, :, 4],
+        "V_final": out[-1, :, 6],
+    }
+
+
+def run_chunk(columns, mode, t_max=250, dt=1, backend=None):
+    """
+    Simulate one chunk of a design as a single batch and summarize it
+    """
+    n = len(next(iter(columns.values())))
+    initial = {k: v for k, v in columns.items() if k in INITIAL}
+    params = {k: v for k, v in columns.items() if k in param}
+    settings = {k: v for k, v in columns.items() if k not in INITIAL and k not in param}
+
+    t, out = run_batch(
+        init_batch(n, **initial),
+        param_array(params, n),
+        feed=make_controller(mode, params=params, **settings),
+        t_max=t_max,
+        dt=dt,
+        backend=backend,
+    )
+    return summarize(t, out)
+
+
+def _run_chunk(args):
+    return run_chunk(*args)
+
+
+def iter_sweep(
+    design,
+    mode="Continuous Feed",
+    fixed=None,
+    t_max=250,
+    dt=1,
+    processes=None,
+    chunksize=None,
+    backend=None,
+):
+    """
+    Run every row of `design` and yield the result table in chunks, each a
+    DataFrame with the design columns followed by OUTPUTS, in design order.
+
+    Rows are split into chunks that are each simulated as one vectorized
+    batch, spread over a pool of `processes` workers (all cores by default,
+    1 runs in this process). `fixed` settings apply to every row.
+    """
+    design = {k: np.asarray(v, dtype="float64") for k, v in design.items()}
+    n = len(next(iter(design.values())))
+    columns = dict(design)
+    for k, v in (fixed or {}).items():
+        columns[k] = np.full(n, v, dtype="float64")
+
+    processes = processes or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = min(max(math.ceil(n / (4 * processes)), 1), 2000)
+
+    chunks = [
+        (
+            {k: v[i : i + chunksize] for k, v in columns.items()},
+            mode,
+            t_max,
+            dt,
+            backend,
+        )
+        for i in range(0, n, chunksize)
+    ]
+
+    def table(chunk, result):
+        table = pd.DataFrame(chunk[0])
+        for k in OUTPUTS:
+            table[k] = result[k]
+        return table
+
+    if processes == 1 or len(chunks) == 1:
+        for chunk in chunks:
+            yield table(chunk, _run_chunk(chunk))
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            for chunk, result in zip(chunks, pool.map(_run_chunk, chunks)):
+                yield table(chunk, result)
+
+
+def run_sweep(
+    design,
+    mode="Continuous Feed",
+    fixed=None,
+    t_max=250,
+    dt=1,
+    processes=None,
+    chunksize=None,
+    backend=None,
+):
+    """
+    Run every row of `design` and return one DataFrame with the design
+    columns followed by OUTPUTS. Takes the arguments of `iter_sweep`.
+    """
+    chunks = list(
+        iter_sweep(design, mode, fixed, t_max, dt, processes, chunksize, backend)
+    )
+    if not chunks:
+        columns = list(design) + [k for k in fixed or {} if k not in design]
+        return pd.DataFrame(columns=columns + OUTPUTS, dtype="float64")
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _values(spec):
+    """
+    "a:b:n" -> n points from a to b, "a,b,c" -> those values
+    """
+    if ":" in spec:
+        start, stop, num = spec.split(":")
+        return np.linspace(float(start), float(stop), int(num))
+    return [float(v) for v in spec.split(",")]
+
+
+def _pairs(items):
+    return [item.split("=", 1) for item in items or []]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m model.sweep", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--mode", default="Continuous Feed", choices=MODES)
+    parser.add_argument(
+        "--grid",
+        action="append",
+        metavar="KEY=A:B:N|A,B,C",
+        help="grid axis, repeat for a full factorial design",
+    )
+    parser.add_argument(
+        "--sample",
+        action="append",
+        metavar="KEY=LOW:HIGH",
+        help="uniformly sampled key, crossed with the grid",
+    )
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--set", action="append", metavar="KEY=VALUE", help="fixed setting"
+    )
+    parser.add_argument("--t-max", type=float, default=250)
+    parser.add_argument("--dt", type=float, default=1)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=None)
+    parser.add_argument("--backend", default=None)
+    parser.add_argument(
+        "--out",
+        help="stream the table to a .csv, .parquet or .arrow file as chunks finish",
+    )
+    args = parser.parse_args(argv)
+
+    designs = []
+    if args.grid:
+        designs.append(grid(**{k: _values(v) for k, v in _pairs(args.grid)}))
+    if args.sample:
+        bounds = {
+            k: tuple(float(b) for b in v.split(":")) for k, v in _pairs(args.sample)
+        }
+        designs.append(sample(args.samples, args.seed, **bounds))
+    if not designs:
+        parser.error("nothing to sweep, give at least one --grid or --sample")
+
+    if args.out and format_of(args.out) not in STREAMING:
+        parser.error(f"--out must end in one of {STREAMING}")
+
+    design = cross(*designs)
+    fixed = {k: float(v) for k, v in _pairs(args.set)}
+
+    options = dict(
+        mode=args.mode,
+        fixed=fixed,
+        t_max=args.t_max,
+        dt=args.dt,
+        processes=args.processes,
+        chunksize=args.chunksize,
+        backend=args.backend,
+    )
+
+    start = time.perf_counter()
+    if args.out:
+        with ChunkWriter(args.out) as out:
+            for chunk in iter_sweep(design, **options):
+                out.write(chunk)
+        runs = out.rows
+    else:
+        table = run_sweep(design, **options)
+        print(table.describe().T.to_string())
+        runs = len(table)
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{runs} runs in {elapsed:.2f} s ({runs / elapsed:.0f} runs/s)",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""
+HTTP service running the simulator for other systems, apart from the app.
+
+    python -m service --port 8080 --processes 4
+
+Endpoints, all taking and returning JSON:
+
+    GET  /health   status, pool and queue sizes, counters
+    POST /run      one scenario, the whole trajectory by column
+    POST /stream   one scenario, the trajectory as NDJSON lines of rows, or
+                   as server-sent events with Accept: text/event-stream
+    POST /sweep    a design (or grid and sample axes) run as batches, one
+                   row of figures of merit per design row
+
+A scenario is given as in `model.scenario`:
+
+    {"initial": {"X_0": 2e5}, "params": {"mu_max": 0.05}, "dt": 1,
+     "t_max": 250, "schedule": [[0, "Bang Control", {"Glc_SP": 20}]]}
+
+or with "mode" and "settings" instead of a schedule. Simulations run in a
+process pool and go through the shared result cache. Requests for a scenario
+that is already being simulated wait for that simulation instead of starting
+another, and once `max_queue` jobs are waiting new ones are turned away with
+503 and a Retry-After header.
+
+`service.loadtest` drives a running service with concurrent requests.
+"""
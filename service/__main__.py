@@ -0,0 +1,35 @@
+"""
+Run the simulator service, see `service`.
+"""
+
+import argparse
+
+from aiohttp import web
+
+from service.server import make_app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m service", description=__doc__.strip()
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--processes", type=int, default=None, help="worker processes, all cores"
+    )
+    parser.add_argument(
+        "--max-queue",
+        type=int,
+        default=None,
+        help="jobs waiting before requests are turned away, 8 per process",
+    )
+    args = parser.parse_args(argv)
+
+    web.run_app(
+        make_app(args.processes, args.max_queue), host=args.host, port=args.port
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Load test of a running simulator service.
+
+    python -m service --port 8080 &
+    python -m service.loadtest --url http://127.0.0.1:8080 --requests 500 \\
+        --concurrency 50 --endpoint run --distinct 20
+
+Sends `requests` requests from `concurrency` concurrent clients. Scenarios
+are drawn from `distinct` different ones, so fewer distinct scenarios than
+clients exercise the coalescing. Reports throughput, latency percentiles
+and the status codes, and the service counters before and after.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import aiohttp
+import numpy as np
+
+
+def scenarios(distinct, seed=None):
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "params": {"mu_max": float(rng.uniform(0.03, 0.06))},
+            "mode": "Bang Control",
+            "settings": {"Glc_SP": float(rng.uniform(10, 30))},
+        }
+        for _ in range(distinct)
+    ]
+
+
+def body_of(endpoint, scenario, sweep_rows):
+    if endpoint == "sweep":
+        return {
+            "sample": {"mu_max": [0.03, 0.06], "Ks_Glc": [1, 4]},
+            "samples": sweep_rows,
+            "mode": scenario["mode"],
+            "fixed": scenario["settings"],
+        }
+    return scenario
+
+
+async def call(session, url, endpoint, body):
+    start = time.perf_counter()
+    async with session.post(f"{url}/{endpoint}", json=body) as response:
+        # read it all, streams included
+        async for _ in response.content.iter_any():
+            pass
+        return response.status, time.perf_counter() - start
+
+
+async def load(url, endpoint, requests, concurrency, distinct, sweep_rows, seed):
+    bodies = [body_of(endpoint, s, sweep_rows) for s in scenarios(distinct, seed)]
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(bodies[i % len(bodies)])
+
+    results = []
+
+    async def client(session):
+        while not queue.empty():
+            body = queue.get_nowait()
+            try:
+                results.append(await call(session, url, endpoint, body))
+            except aiohttp.ClientError as e:
+                results.append((type(e).__name__, 0.0))
+
+    timeout = aiohttp.ClientTimeout(total=600)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        async with session.get(f"{url}/health") as response:
+            before = await response.json()
+        start = time.perf_counter()
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        async with session.get(f"{url}/health") as response:
+            after = await response.json()
+
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ms = np.array([t for status, t in results if status == 200]) * 1000
+    latency = (
+        {
+            "mean": float(ms.mean()),
+            **{f"p{q}": float(np.percentile(ms, q)) for q in [50, 90, 99]},
+            "max": float(ms.max()),
+        }
+        if len(ms)
+        else {}
+    )
+    return {
+        "endpoint": endpoint,
+        "requests": requests,
+        "concurrency": concurrency,
+        "distinct": distinct,
+        "elapsed": elapsed,
+        "per_second": requests / elapsed,
+        "statuses": statuses,
+        "latency_ms": latency,
+        "service": {
+            k: after[k] - before.get(k, 0)
+            for k in ["jobs", "coalesced", "rejected"]
+            if k in after
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m service.loadtest", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--endpoint", default="run", choices=["run", "stream", "sweep"])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--distinct", type=int, default=10, help="different scenarios sent"
+    )
+    parser.add_argument(
+        "--sweep-rows", type=int, default=1000, help="rows of each sweep"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(
+        load(
+            args.url.rstrip("/"),
+            args.endpoint,
+            args.requests,
+            args.concurrency,
+            args.distinct,
+            args.sweep_rows,
+            args.seed,
+        )
+    )
+    print(json.dumps(report, indent=2))
+    print(
+        "{requests} requests in {elapsed:.2f} s ({per_second:.0f}/s), "
+        "statuses {statuses}".format(**report),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
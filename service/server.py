@@ -0,0 +1,444 @@
+"""
+aiohttp application of the simulator service, see `service`.
+"""
+
+import asyncio
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
+import numpy as np
+from aiohttp import web
+
+from model.cache import default_cache
+from model.control import MODES, make_controller
+from model.run import INITIAL, n_steps, param
+from model.scenario import scenario, scenario_key, simulate_scenario
+from model.sweep import OUTPUTS, cross, grid, run_chunk, sample
+
+# rows of a sweep and of a stream chunk
+MAX_SWEEP = 200_000
+SWEEP_CHUNK = 2000
+STREAM_CHUNK = 25
+
+# steps of a run, steps times rows of a whole sweep and of one of its chunks
+MAX_STEPS = 100_000
+MAX_SWEEP_STEPS = 50_000_000
+CHUNK_STEPS = 1_000_000
+
+# seconds a turned away client is asked to wait
+RETRY_AFTER = 1
+
+
+def simulate_job(scenario):
+    """
+    Trajectory of a scenario, run in a worker process
+    """
+    return simulate_scenario(scenario, default_cache())
+
+
+class ValidationError(ValueError):
+    """
+    A request that cannot be run, answered with 400
+    """
+
+
+def _numbers(values, what, names=None):
+    """
+    Dict of floats from a request mapping, whose keys are all in `names` if
+    given
+    """
+    if not isinstance(values, dict):
+        raise ValidationError(f"Expected {what} as an object")
+    unknown = [k for k in values if names is not None and k not in names]
+    if unknown:
+        raise ValidationError(f"Unknown {what} {unknown}")
+    try:
+        numbers = {k: float(v) for k, v in values.items()}
+    except (TypeError, ValueError):
+        raise ValidationError(f"Expected numbers as {what}") from None
+    if not all(map(math.isfinite, numbers.values())):
+        raise ValidationError(f"Expected finite numbers as {what}")
+    return numbers
+
+
+def parse_initial(values):
+    """
+    Initial conditions of a request, with cells and volume to start from
+    """
+    initial = _numbers(values, "initial conditions", INITIAL)
+    if any(v < 0 for v in initial.values()):
+        raise ValidationError("Initial conditions must not be negative")
+    if initial.get("X_0", 1) <= 0 or initial.get("V_0", 1) <= 0:
+        raise ValidationError("Expected positive X_0 and V_0")
+    return initial
+
+
+def parse_step(value, t_max):
+    """
+    Step time of a run to t_max, within MAX_STEPS steps
+    """
+    try:
+        dt = float(value)
+    except (TypeError, ValueError):
+        raise ValidationError("Expected a number as dt") from None
+    if not 0 < dt <= t_max:
+        raise ValidationError("Expected 0 < dt <= t_max <= 10000")
+    if n_steps(t_max, dt) > MAX_STEPS:
+        raise ValidationError(f"t_max / dt is limited to {MAX_STEPS} steps")
+    return dt
+
+
+def parse_horizon(body):
+    """
+    (dt, t_max) of a request body
+    """
+    try:
+        t_max = float(body.get("t_max", 250))
+    except (TypeError, ValueError):
+        raise ValidationError("Expected a number as t_max") from None
+    if not 0 < t_max <= 10_000:
+        raise ValidationError("Expected 0 < dt <= t_max <= 10000")
+    return parse_step(body.get("dt", 1), t_max), t_max
+
+
+def check_controls(mode, settings):
+    """
+    Raise ValidationError unless `settings` make a controller for `mode`
+    """
+    if mode not in MODES:
+        raise ValidationError(
+            f"Unknown control mode {mode!r}, expected one of {MODES}"
+        )
+    try:
+        make_controller(mode, **settings)
+    except (TypeError, ValueError, ZeroDivisionError) as e:
+        raise ValidationError(f"Invalid {mode} settings: {e}") from None
+
+
+def parse_scenario(body):
+    """
+    Canonical scenario dict from a request body
+    """
+    if not isinstance(body, dict):
+        raise ValidationError("Expected a JSON object")
+    schedule = body.get("schedule")
+    if schedule is None:
+        mode = body.get("mode", "Continuous Feed")
+        schedule = [[0.0, mode, body.get("settings", {})]]
+    if not isinstance(schedule, list) or not schedule:
+        raise ValidationError("Expected a list of schedule entries")
+    dt, t_max = parse_horizon(body)
+
+    entries = []
+    for entry in schedule:
+        if not isinstance(entry, list) or len(entry) not in (3, 4):
+            raise ValidationError(
+                "Schedule entries are [t, mode, settings] or [t, mode, settings, dt]"
+            )
+        t, mode, settings = entry[:3]
+        settings = _numbers(settings, "settings")
+        check_controls(mode, settings)
+        try:
+            t = float(t)
+        except (TypeError, ValueError):
+            raise ValidationError("Expected a number as the schedule time") from None
+        if not 0 <= t <= t_max:
+            raise ValidationError("Expected schedule times within 0 <= t <= t_max")
+        if entries and t < entries[-1][0]:
+            raise ValidationError("Expected the schedule in time order")
+        if len(entry) == 4:
+            entries.append([t, mode, settings, parse_step(entry[3], t_max)])
+        else:
+            entries.append([t, mode, settings])
+    if entries[0][0] != 0:
+        raise ValidationError("Expected the schedule to start at t=0")
+
+    return scenario(
+        parse_initial(body.get("initial", {})),
+        _numbers(body.get("params") or {}, "constants", param),
+        entries,
+        dt=dt,
+        t_max=t_max,
+    )
+
+
+def parse_design(body):
+    """
+    Sweep design from a request body: a "design" of columns, "grid" axes of
+    values and "sample" ranges with "samples" rows, crossed together
+    """
+    if not isinstance(body, dict):
+        raise ValidationError("Expected a JSON object")
+    designs = []
+    try:
+        if body.get("design"):
+            designs.append(body["design"])
+        if body.get("grid"):
+            designs.append(grid(**body["grid"]))
+        if body.get("sample"):
+            bounds = {k: tuple(v) for k, v in body["sample"].items()}
+            designs.append(
+                sample(int(body.get("samples", 100)), body.get("seed"), **bounds)
+            )
+        if designs:
+            design = {
+                k: np.asarray(v, dtype="float64") for k, v in cross(*designs).items()
+            }
+    except (AttributeError, TypeError, ValueError) as e:
+        raise ValidationError(f"Invalid design: {e}") from None
+    if not designs:
+        raise ValidationError("Nothing to sweep, give a design, grid or sample")
+
+    sizes = {v.shape for v in design.values()}
+    if len(sizes) != 1 or len(next(iter(sizes))) != 1:
+        raise ValidationError("Design columns must be lists of the same length")
+    n = sizes.pop()[0]
+    if not n:
+        raise ValidationError("The design has no rows")
+    if n > MAX_SWEEP:
+        raise ValidationError(f"{n} rows, a sweep is limited to {MAX_SWEEP}")
+    return design, n
+
+
+def _columns(records):
+    return {k: records[k].tolist() for k in records.dtype.names}
+
+
+class Busy(Exception):
+    pass
+
+
+class Simulator:
+    """
+    Process pool with request coalescing and a bounded queue
+    """
+
+    def __init__(self, processes=None, max_queue=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.max_queue = max_queue or 8 * self.processes
+        self.pool = None
+        self.slots = None
+        # scenario key -> future of its trajectory
+        self.inflight = {}
+        self.queued = 0
+        self.running = 0
+        self.stats = {"jobs": 0, "coalesced": 0, "rejected": 0}
+
+    async def start(self, app=None):
+        self.pool = ProcessPoolExecutor(self.processes)
+        self.slots = asyncio.Semaphore(self.processes)
+
+    async def stop(self, app=None):
+        self.pool.shutdown(cancel_futures=True)
+
+    @asynccontextmanager
+    async def admit(self):
+        """
+        Hold a place in the queue, or raise Busy if it is full
+        """
+        if self.queued >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise Busy()
+        self.queued += 1
+        try:
+            yield
+        finally:
+            self.queued -= 1
+
+    async def execute(self, fn, *args):
+        """
+        Run fn(*args) in the pool once a worker is free
+        """
+        async with self.slots:
+            self.stats["jobs"] += 1
+            self.running += 1
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.pool, fn, *args)
+            finally:
+                self.running -= 1
+
+    async def submit(self, fn, *args):
+        async with self.admit():
+            return await self.execute(fn, *args)
+
+    async def trajectory(self, scenario):
+        """
+        Trajectory of a scenario, shared with the requests for the same one
+        that are in flight
+        """
+        key = scenario_key(scenario)
+        future = self.inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+        else:
+            future = asyncio.ensure_future(self.submit(simulate_job, scenario))
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # a client that goes away does not cancel the others' simulation
+        return key, await asyncio.shield(future)
+
+    def health(self):
+        return {
+            "status": "ok",
+            "processes": self.processes,
+            "running": self.running,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "inflight": len(self.inflight),
+            **self.stats,
+        }
+
+
+def _error(status, message, **headers):
+    return web.json_response({"error": message}, status=status, headers=headers)
+
+
+@web.middleware
+async def errors(request, handler):
+    """
+    Bad input as 400 and a full queue as 503
+    """
+    try:
+        return await handler(request)
+    except json.JSONDecodeError as e:
+        return _error(400, f"Invalid JSON: {e}")
+    except ValidationError as e:
+        return _error(400, str(e))
+    except Busy:
+        return _error(
+            503, "Too many requests queued", **{"Retry-After": str(RETRY_AFTER)}
+        )
+
+
+async def health(request):
+    return web.json_response(request.app["simulator"].health())
+
+
+async def run(request):
+    simulator = request.app["simulator"]
+    start = time.perf_counter()
+    key, records = await simulator.trajectory(parse_scenario(await request.json()))
+    return web.json_response(
+        {
+            "key": key,
+            "rows": len(records),
+            "elapsed": time.perf_counter() - start,
+            "data": _columns(records),
+        }
+    )
+
+
+async def stream(request):
+    """
+    Trajectory of one scenario in chunks of rows, NDJSON by default or
+    server-sent events. Each write waits for the client to take the last
+    one, so a slow reader does not pile rows up in the server.
+    """
+    simulator = request.app["simulator"]
+    try:
+        chunk = max(int(request.query.get("chunk", STREAM_CHUNK)), 1)
+    except ValueError:
+        raise ValidationError("Expected an integer as chunk") from None
+    key, records = await simulator.trajectory(parse_scenario(await request.json()))
+
+    sse = "text/event-stream" in request.headers.get("Accept", "")
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream" if sse else "application/x-ndjson",
+            "Cache-Control": "no-cache",
+            "X-Scenario-Key": key,
+        }
+    )
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    names = records.dtype.names
+    for i in range(0, len(records), chunk):
+        rows = records[i : i + chunk].tolist()
+        if sse:
+            text = "".join(
+                f"data: {json.dumps(dict(zip(names, row)))}\n\n" for row in rows
+            )
+        else:
+            text = "".join(json.dumps(dict(zip(names, row))) + "\n" for row in rows)
+        await response.write(text.encode())
+    if sse:
+        await response.write(b"event: end\ndata: {}\n\n")
+    await response.write_eof()
+    return response
+
+
+async def sweep(request):
+    simulator = request.app["simulator"]
+    body = await request.json()
+    design, n = parse_design(body)
+    mode = body.get("mode", "Continuous Feed")
+    fixed = _numbers(body.get("fixed", {}), "fixed settings")
+    dt, t_max = parse_horizon(body)
+    # the settings of the first row stand for the others
+    first = {k: float(v[0]) for k, v in design.items()}
+    check_controls(
+        mode,
+        {
+            k: v
+            for k, v in {**first, **fixed}.items()
+            if k not in INITIAL and k not in param
+        },
+    )
+
+    steps = n_steps(t_max, dt)
+    if n * steps > MAX_SWEEP_STEPS:
+        raise ValidationError(
+            f"{n} rows of {steps} steps, a sweep is limited to {MAX_SWEEP_STEPS}"
+        )
+
+    start = time.perf_counter()
+    columns = dict(design)
+    for k, v in fixed.items():
+        columns[k] = np.full(n, v)
+    # a chunk holds the whole trajectory of each of its rows
+    size = min(
+        max(math.ceil(n / simulator.processes), 1),
+        SWEEP_CHUNK,
+        max(CHUNK_STEPS // max(steps, 1), 1),
+    )
+    chunks = [
+        {k: v[i : i + size] for k, v in columns.items()} for i in range(0, n, size)
+    ]
+    # the sweep takes one place in the queue, its chunks share the workers
+    async with simulator.admit():
+        results = await asyncio.gather(
+            *[simulator.execute(run_chunk, c, mode, t_max, dt) for c in chunks]
+        )
+
+    data = {k: v.tolist() for k, v in design.items()}
+    for k in OUTPUTS:
+        data[k] = np.concatenate([r[k] for r in results]).tolist()
+    return web.json_response(
+        {"rows": n, "elapsed": time.perf_counter() - start, "data": data}
+    )
+
+
+def make_app(processes=None, max_queue=None):
+    """
+    The service, with its own pool of `processes` workers
+    """
+    app = web.Application(middlewares=[errors], client_max_size=16 * 2**20)
+    simulator = Simulator(processes, max_queue)
+    app["simulator"] = simulator
+    app.on_startup.append(simulator.start)
+    app.on_cleanup.append(simulator.stop)
+    app.add_routes(
+        [
+            web.get("/health", health),
+            web.post("/run", run),
+            web.post("/stream", stream),
+            web.post("/sweep", sweep),
+        ]
+    )
+    return app